@@ -188,3 +188,182 @@ def kinetic_nuc_1d(xi, xj, di, dj, xwi, xwj):
     kinetic = (dkerfac + c1i * dkeifac) * olap
 
     return kinetic
+
+
+# compute the overlap matrix of two sets of nuclear TBFs (electronic part
+# not included).  This is the all-pairs version of overlap_nuc, evaluated
+# with NumPy broadcasting instead of a python loop over pairs and
+# dimensions.  Returns an (ntraj_i, ntraj_j) complex array
+def overlap_nuc_matrix(ri, rj, pi, pj, widthsi, widthsj):
+    return overlap_nuc_array(np.asarray(ri)[:, np.newaxis, :],
+                             np.asarray(rj)[np.newaxis, :, :],
+                             np.asarray(pi)[:, np.newaxis, :],
+                             np.asarray(pj)[np.newaxis, :, :],
+                             np.asarray(widthsi)[:, np.newaxis, :],
+                             np.asarray(widthsj)[np.newaxis, :, :])
+
+
+# compute the nuclear overlap, kinetic energy and Sdot matrices of two sets
+# of TBFs in one pass.  The 1D overlap factors are computed only once and
+# shared by all three matrices: since every 1D kinetic energy factor is
+# proportional to the corresponding 1D overlap, T and Sdot are S times a
+# sum over dimensions.  fj are the forces on the TBFs j, massesi the masses
+# of the TBFs i.  Returns the tuple (S, T, Sdot)
+def overlap_kinetic_Sdot_nuc_matrix(ri, rj, pi, pj, fj, widthsi, widthsj, massesi):
+    return overlap_kinetic_Sdot_nuc_array(np.asarray(ri)[:, np.newaxis, :],
+                                          np.asarray(rj)[np.newaxis, :, :],
+                                          np.asarray(pi)[:, np.newaxis, :],
+                                          np.asarray(pj)[np.newaxis, :, :],
+                                          np.asarray(fj)[np.newaxis, :, :],
+                                          np.asarray(widthsi)[:, np.newaxis, :],
+                                          np.asarray(widthsj)[np.newaxis, :, :],
+                                          np.asarray(massesi)[:, np.newaxis, :])
+
+
+# compute the nuclear overlap, kinetic energy and Sdot elements of a list of
+# pairs of TBFs.  Row k of the (npair, ndim) arrays describes the pair k, as
+# in overlap_nuc_pairs.  Returns the tuple (S, T, Sdot) of (npair) arrays
+def overlap_kinetic_Sdot_nuc_pairs(ri, rj, pi, pj, fj, widthsi, widthsj, massesi):
+    return overlap_kinetic_Sdot_nuc_array(np.asarray(ri), np.asarray(rj), np.asarray(pi),
+                                          np.asarray(pj), np.asarray(fj), np.asarray(widthsi),
+                                          np.asarray(widthsj), np.asarray(massesi))
+
+
+# elementwise version of overlap_kinetic_Sdot_nuc_matrix for (broadcastable)
+# numpy arrays, with the dimensions along the last axis
+def overlap_kinetic_Sdot_nuc_array(xi, xj, di, dj, fj, xwi, xwj, mi):
+    c1i = (complex(0.0, 1.0))
+    Smat = overlap_nuc_array(xi, xj, di, dj, xwi, xwj)
+
+    deltax = xi - xj
+    psum = di + dj
+    pdiff = di - dj
+
+    # kinetic energy, as in kinetic_nuc_1d
+    dkerfac = xwi + 0.25 * psum * psum - xwi * xwi * deltax * deltax
+    dkeifac = xwi * deltax * psum
+    Tmat = Smat * np.sum(0.5 * (dkerfac + c1i * dkeifac) / mi, axis=-1)
+
+    # Sdot, as in Sdot_nuc
+    o4wj = 0.25 / xwj
+    Cdbydr = xwj * deltax - (0.5 * c1i) * psum
+    Cdbydp = o4wj * pdiff + (0.5 * c1i) * deltax
+    Sdotmat = Smat * np.sum(Cdbydr * dj / mi + Cdbydp * fj, axis=-1)
+
+    return Smat, Tmat, Sdotmat
+
+
+# compute the width-scaled phase-space distance between two sets of nuclear
+# TBFs, the sum over dimensions of (wi*wj*dx^2 + 0.25*dp^2) / (wi + wj).
+# The prefactor of every 1D overlap is at most one, so
+# |S_ij| <= exp(-distance_ij), which makes this a cheap bound for
+# screening negligible pairs.  Returns an (ntraj_i, ntraj_j) real array
+def phase_space_distance_matrix(ri, rj, pi, pj, widthsi, widthsj):
+    return phase_space_distance_array(np.asarray(ri)[:, np.newaxis, :],
+                                      np.asarray(rj)[np.newaxis, :, :],
+                                      np.asarray(pi)[:, np.newaxis, :],
+                                      np.asarray(pj)[np.newaxis, :, :],
+                                      np.asarray(widthsi)[:, np.newaxis, :],
+                                      np.asarray(widthsj)[np.newaxis, :, :])
+
+
+# pair version of phase_space_distance_matrix, as in overlap_nuc_pairs.
+# Returns an (npair) real array
+def phase_space_distance_pairs(ri, rj, pi, pj, widthsi, widthsj):
+    return phase_space_distance_array(np.asarray(ri), np.asarray(rj), np.asarray(pi),
+                                      np.asarray(pj), np.asarray(widthsi), np.asarray(widthsj))
+
+
+# elementwise version of phase_space_distance_matrix for (broadcastable)
+# numpy arrays, with the dimensions along the last axis
+def phase_space_distance_array(xi, xj, di, dj, xwi, xwj):
+    deltax = xi - xj
+    pdiff = di - dj
+    return np.sum((xwi * xwj * deltax * deltax + 0.25 * pdiff * pdiff) / (xwi + xwj), axis=-1)
+
+
+# compute the overlaps of a list of pairs of nuclear TBFs.  Row k of the
+# (npair, ndim) arrays ri, pi, widthsi and rj, pj, widthsj describes the
+# pair k.  Returns an (npair) complex array
+def overlap_nuc_pairs(ri, rj, pi, pj, widthsi, widthsj):
+    return overlap_nuc_array(np.asarray(ri), np.asarray(rj), np.asarray(pi),
+                             np.asarray(pj), np.asarray(widthsi), np.asarray(widthsj))
+
+
+# compute the nuclear overlaps of (broadcastable) numpy arrays of TBFs, with
+# the dimensions along the last axis, in the log domain: the 1D
+# log-magnitudes and phases are summed over the dimensions before a single
+# exponentiation, so no partial product underflows however many
+# dimensions there are.  Unlike overlap_nuc_1d, there is no cutoff of the
+# distant pairs in a single dimension (see the pair screening instead)
+def overlap_nuc_array(xi, xj, di, dj, xwi, xwj):
+    logabs, phase = log_overlap_nuc_1d_array(xi, xj, di, dj, xwi, xwj)
+    return np.exp(np.sum(logabs, axis=-1) + (complex(0.0, 1.0)) * np.sum(phase, axis=-1))
+
+
+# compute the log-magnitude and the phase of the 1-dimensional nuclear
+# overlaps for (broadcastable) numpy arrays, so that
+# overlap_nuc_1d = exp(logabs + 1j * phase).  There is no cutoff: in the
+# log domain a large exponent is harmless
+def log_overlap_nuc_1d_array(xi, xj, di, dj, xwi, xwj):
+    deltax = xi - xj
+    pdiff = di - dj
+    osmwid = 1.0 / (xwi + xwj)
+
+    xrarg = osmwid * (xwi * xwj * deltax * deltax + 0.25 * pdiff * pdiff)
+    logabs = 0.5 * np.log(2.0 * np.sqrt(xwi * xwj) * osmwid) - xrarg
+
+    phase = (di * xi - dj * xj)
+    phase = phase - osmwid * (xwi * xi + xwj * xj) * pdiff
+
+    return logabs, phase
+
+
+# compute the log-magnitude of the overlap matrix of two sets of nuclear
+# TBFs.  The exponents are summed over all dimensions, so unlike
+# overlap_nuc_matrix nothing underflows for many dimensions and the
+# result can be compared to log(threshold) without forming the complex
+# overlaps.  Returns an (ntraj_i, ntraj_j) real array
+def log_abs_overlap_nuc_matrix(ri, rj, pi, pj, widthsi, widthsj):
+    logabs, phase = log_overlap_nuc_1d_array(np.asarray(ri)[:, np.newaxis, :],
+                                             np.asarray(rj)[np.newaxis, :, :],
+                                             np.asarray(pi)[:, np.newaxis, :],
+                                             np.asarray(pj)[np.newaxis, :, :],
+                                             np.asarray(widthsi)[:, np.newaxis, :],
+                                             np.asarray(widthsj)[np.newaxis, :, :])
+    return np.sum(logabs, axis=2)
+
+
+# same as log_abs_overlap_nuc_matrix, with the electronic part included:
+# the log-magnitude is -inf for TBFs on different electronic states
+def log_abs_overlap_nuc_elec_matrix(ri, rj, pi, pj, widthsi, widthsj, istatesi, istatesj):
+    logabs = log_abs_overlap_nuc_matrix(ri, rj, pi, pj, widthsi, widthsj)
+    same_state = np.equal.outer(istatesi, istatesj)
+    logabs[np.logical_not(same_state)] = -np.inf
+    return logabs
+
+
+# compute the log-magnitude of the overlap of two nuclear TBFs, with the
+# same arguments as overlap_nuc
+def log_abs_overlap_nuc(ti, tj, positions_i="positions", positions_j="positions", momenta_i="momenta",
+                        momenta_j="momenta"):
+    if isinstance(positions_i, types.StringTypes):
+        ri = eval("ti.get_" + positions_i + "()")
+    else:
+        ri = positions_i
+    if isinstance(positions_j, types.StringTypes):
+        rj = eval("tj.get_" + positions_j + "()")
+    else:
+        rj = positions_j
+    if isinstance(momenta_i, types.StringTypes):
+        pi = eval("ti.get_" + momenta_i + "()")
+    else:
+        pi = momenta_i
+    if isinstance(momenta_j, types.StringTypes):
+        pj = eval("tj.get_" + momenta_j + "()")
+    else:
+        pj = momenta_j
+
+    logabs, phase = log_overlap_nuc_1d_array(np.asarray(ri), np.asarray(rj), np.asarray(pi),
+                                             np.asarray(pj), ti.get_widths(), tj.get_widths())
+    return np.sum(logabs)
@@ -2,6 +2,7 @@ import math
 
 import h5py
 import numpy as np
+from pyspawn import h5output
 from typing import Dict, Any
 
 
@@ -67,30 +68,30 @@ class fafile(object):
         self.datasets["istates"] = self.istates
 
     def fill_qm_amplitudes(self):
-        c = self.h5file["sim/qm_amplitudes"][()]
+        c = h5output.read_rows(self.h5file["sim/qm_amplitudes"])
         self.datasets["qm_amplitudes"] = c
 
     def fill_S(self):
-        S = self.h5file["sim/S"][()]
+        S = h5output.read_rows(self.h5file["sim/S"])
         self.datasets["S"] = S
 
     def retrieve_num_traj_qm(self):
-        self.ntraj = self.h5file["sim/num_traj_qm"][()].flatten()
+        self.ntraj = h5output.read_rows(self.h5file["sim/num_traj_qm"]).flatten()
 
     def get_numstates(self):
         self.datasets['numstates'] = self.numstates
 
     def fill_quantum_times(self):
-        times = self.h5file["sim/quantum_time"][()]
+        times = h5output.read_rows(self.h5file["sim/quantum_time"])
         self.datasets["quantum_times"] = times
 
     def fill_traj_time(self):
         for key in self.labels:
             trajgrp = "traj_" + key
-            time = self.h5file[trajgrp]['time'][()]
+            time = self.get_traj_data_from_h5(key, 'time')
             key2 = key + "_time"
             self.datasets[key2] = time
-            time = self.h5file[trajgrp]['time_half_step'][()]
+            time = self.get_traj_data_from_h5(key, 'time_half_step')
             key3 = key + "_time_half_step"
             self.datasets[key3] = time
 
@@ -106,8 +107,14 @@ class fafile(object):
         return S_t
 
     def get_traj_data_from_h5(self, label, key):
-        trajgrp = "traj_" + label
-        return self.h5file[trajgrp][key][()]
+        """Time ordered data of a trajectory, including the rows of a
+        backpropagation that has not reached mintime yet (which are stored
+        in reverse time order in the backprop_ dataset)"""
+        trajgrp = self.h5file["traj_" + label]
+        data = h5output.read_rows(trajgrp[key])
+        if "backprop_" + key in trajgrp:
+            data = np.concatenate((h5output.read_rows(trajgrp["backprop_" + key])[::-1], data))
+        return data
 
     def get_traj_attr_from_h5(self, label, key):
         trajgrp = "traj_" + label
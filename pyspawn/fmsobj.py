@@ -15,6 +15,11 @@ class fmsobj(object):
         """Convert fmsobj structure to python dict structure"""
 
         tempdict = self.__dict__.copy()
+        # attributes starting with an underscore are transient (caches and
+        # the like) and are not part of the restart information
+        for key in tempdict.keys():
+            if key[0] == "_":
+                del tempdict[key]
         for key in tempdict:
             # numpy objects
             if type(tempdict[key]).__module__ == np.__name__:
@@ -91,12 +96,17 @@ class fmsobj(object):
                                                            dtype=np.complex128)
         self.__dict__.update(tempdict)
 
+    def to_json(self):
+        """Convert fmsobj structure to a json string"""
+
+        tempdict = self.to_dict()
+        return json.dumps(tempdict, sort_keys=True, indent=4, separators=(',', ': '))
+
     def write_to_file(self, outfilename):
         """Write fmsobj structure to disk in json format"""
 
-        tempdict = self.to_dict()
         with open(outfilename, 'w') as outputfile:
-            json.dump(tempdict, outputfile, sort_keys=True, indent=4, separators=(',', ': '))
+            outputfile.write(self.to_json())
 
     def read_from_file(self, infilename):
         """Read fmsobj structure from json file"""
@@ -0,0 +1,131 @@
+import threading
+import h5py
+from pyspawn import h5output
+
+######################################################
+# process-wide cache of the open working hdf5 file
+######################################################
+
+# The trajectories, the centroids and the simulation all write their output
+# to working.hdf5 and read their history back from it.  Instead of opening
+# and closing the file (and parsing the metadata of all its groups) at each
+# access, the file is opened once by the process and the handles of its
+# groups and datasets are kept, by path.  Changes reach the disk when the
+# file is flushed (before it is copied to sim.hdf5 by restart_output) or
+# closed (before it is replaced or removed).  All accesses hold lock.
+
+# serializes the access to the file when tasks run in parallel threads
+lock = threading.RLock()
+
+
+class h5_file_cache(object):
+    """The hdf5 file filename, opened in append mode when first accessed,
+    and the handles of its groups and datasets"""
+
+    def __init__(self, filename="working.hdf5"):
+        self.filename = filename
+        # number of times the file has been opened
+        self.nopen = 0
+
+        self._h5f = None
+        self._groups = dict()
+        self._datasets = dict()
+
+    def is_open(self):
+        return self._h5f is not None
+
+    def get_file(self):
+        """The open file"""
+
+        with lock:
+            if self._h5f is None:
+                self._h5f = h5py.File(self.filename, "a")
+                self.nopen += 1
+            return self._h5f
+
+    def get_group(self, groupname):
+        """The group groupname, None if it does not exist"""
+
+        with lock:
+            grp = self._groups.get(groupname)
+            if grp is None:
+                grp = self.get_file().get(groupname)
+                if grp is not None:
+                    self._groups[groupname] = grp
+            return grp
+
+    def create_group(self, groupname):
+        with lock:
+            grp = self.get_file().create_group(groupname)
+            self._groups[groupname] = grp
+            return grp
+
+    def get_dataset(self, groupname, name):
+        """The dataset name of the group groupname, None if it does not
+        exist"""
+
+        path = groupname + "/" + name
+        with lock:
+            dset = self._datasets.get(path)
+            if dset is None:
+                grp = self.get_group(groupname)
+                if grp is None:
+                    return None
+                dset = grp.get(name)
+                if dset is not None:
+                    self._datasets[path] = dset
+            return dset
+
+    def widen_dataset(self, groupname, name, n):
+        """Recreate the dataset name of the group groupname with n columns
+        (see h5output.widen), returns the new dataset"""
+
+        with lock:
+            self._datasets.pop(groupname + "/" + name, None)
+            h5output.widen(self.get_group(groupname), name, n)
+            return self.get_dataset(groupname, name)
+
+    def delete_dataset(self, groupname, name):
+        with lock:
+            self._datasets.pop(groupname + "/" + name, None)
+            grp = self.get_group(groupname)
+            if grp is not None and name in grp:
+                del grp[name]
+
+    def flush(self):
+        """Write the changes to the disk, the file stays open"""
+
+        with lock:
+            if self._h5f is not None:
+                self._h5f.flush()
+
+    def close(self):
+        """Close the file and drop the handles, the file is opened again by
+        the next access"""
+
+        with lock:
+            self._groups = dict()
+            self._datasets = dict()
+            if self._h5f is not None:
+                self._h5f.close()
+                self._h5f = None
+
+
+# the working file of the process
+_cache = h5_file_cache("working.hdf5")
+
+
+def get_cache():
+    """The cache of working.hdf5"""
+
+    return _cache
+
+
+def flush():
+    _cache.flush()
+
+
+def close():
+    _cache.close()
+
+######################################################
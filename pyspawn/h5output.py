@@ -0,0 +1,164 @@
+import shutil
+import h5py
+import numpy as np
+
+######################################################
+# chunked, compressed and preallocated hdf5 output datasets
+######################################################
+
+# The output datasets grow along their first (time) axis.  They are chunked
+# along that axis, optionally compressed, and when they are full their
+# capacity is doubled instead of growing them one row at a time.  The
+# number of rows actually written is kept in the attribute "length", and
+# readers of working.hdf5 use get_length / read_rows instead of the shape
+# of the dataset.  The copies of working.hdf5 made during the simulation
+# (sim.hdf5 and its backups) keep the preallocated rows and the attribute;
+# the sim.hdf5 left at the end of the simulation, or when the walltime
+# expires, is trimmed to the rows written (see trim_file), so that it can
+# be read by any reader.  Datasets without the attribute (files of older
+# versions) have as many rows as their shape says.
+
+# filters and chunk size of the datasets created by this process (see
+# set_options)
+_options = {"compression": None,
+            "compression_opts": None,
+            "shuffle": False,
+            "chunk_bytes": 65536}
+
+# bounds of the number of rows of a chunk
+_min_chunk_rows = 16
+_max_chunk_rows = 1024
+
+
+def set_options(compression=None, compression_opts=None, shuffle=False,
+                chunk_bytes=65536):
+    """Set the filters of the new datasets: compression is None, "gzip" or
+    "lzf" (compression_opts is the gzip level), shuffle enables the byte
+    shuffle filter.  The chunks hold about chunk_bytes bytes"""
+
+    _options["compression"] = compression
+    _options["compression_opts"] = compression_opts
+    _options["shuffle"] = shuffle
+    _options["chunk_bytes"] = chunk_bytes
+
+
+def get_options():
+    return _options.copy()
+
+
+def get_chunk_rows(n, dtype):
+    """Number of rows of the chunks of a dataset with n columns"""
+
+    rows = _options["chunk_bytes"] // (max(n, 1) * np.dtype(dtype).itemsize)
+    return int(min(max(rows, _min_chunk_rows), _max_chunk_rows))
+
+
+def create_dataset(grp, name, n, dtype="float64", maxshape=None):
+    """Create an empty output dataset with n columns in the group grp"""
+
+    if maxshape is None:
+        maxshape = (None, n)
+    ncol = max(n, 1)
+    kwargs = dict()
+    if _options["compression"] is not None:
+        kwargs["compression"] = _options["compression"]
+        if _options["compression_opts"] is not None:
+            kwargs["compression_opts"] = _options["compression_opts"]
+    if _options["shuffle"]:
+        kwargs["shuffle"] = True
+    dset = grp.create_dataset(name, (0, n), maxshape=maxshape, dtype=dtype,
+                              chunks=(get_chunk_rows(ncol, dtype), ncol),
+                              **kwargs)
+    dset.attrs["length"] = 0
+    return dset
+
+
+def widen(grp, name, n):
+    """Recreate the output dataset name of the group grp with n columns
+    (more than it has), with the rows written and chunks of the new width.
+    Returns the new dataset"""
+
+    dset = grp[name]
+    l = get_length(dset)
+    rows = dset[0:l]
+    dtype = dset.dtype
+    maxshape = dset.maxshape
+    del grp[name]
+    dset = create_dataset(grp, name, n, dtype=dtype, maxshape=maxshape)
+    set_length(dset, l)
+    dset[0:l, 0:rows.shape[1]] = rows
+    return dset
+
+
+def get_length(dset):
+    """Number of rows written to dset"""
+
+    if "length" in dset.attrs:
+        return int(dset.attrs["length"])
+    return dset.len()
+
+
+def set_length(dset, l):
+    """Set the number of rows written to dset to l, doubling the capacity
+    of dset as many times as needed"""
+
+    capacity = dset.len()
+    if l > capacity:
+        if dset.chunks is not None:
+            capacity = max(capacity, dset.chunks[0])
+        capacity = max(capacity, 1)
+        while capacity < l:
+            capacity *= 2
+        dset.resize(capacity, axis=0)
+    dset.attrs["length"] = l
+
+
+def append_row(dset):
+    """Add a row to dset, returns its index"""
+
+    l = get_length(dset)
+    set_length(dset, l + 1)
+    return l
+
+
+def read_rows(dset):
+    """The rows written to dset"""
+
+    return dset[0:get_length(dset)]
+
+
+def trim(dset):
+    """Release the capacity of dset beyond the rows written"""
+
+    l = get_length(dset)
+    if dset.len() != l:
+        dset.resize(l, axis=0)
+
+
+def trim_file(filename):
+    """Trim all output datasets of the hdf5 file filename, so that readers
+    unaware of the length attribute see only the rows written.  The file
+    is rewritten to release the space of the trimmed rows and of the chunks
+    rewritten during the simulation (with compression, the rewritten chunks
+    do not fit in place)"""
+
+    h5f = h5py.File(filename, "a")
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and "length" in obj.attrs:
+            trim(obj)
+
+    h5f.visititems(visit)
+    h5f.flush()
+
+    tmpname = filename + ".trim"
+    h5f_new = h5py.File(tmpname, "w")
+    for key in h5f.attrs:
+        h5f_new.attrs[key] = h5f.attrs[key]
+    for key in h5f:
+        h5f.copy(key, h5f_new)
+    h5f_new.close()
+    h5f.close()
+    shutil.move(tmpname, filename)
+
+######################################################
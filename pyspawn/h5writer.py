@@ -0,0 +1,181 @@
+import sys
+import threading
+import numpy as np
+from collections import OrderedDict
+from pyspawn import h5cache
+from pyspawn import h5output
+
+######################################################
+# write-behind queue of the working hdf5 output
+######################################################
+
+# The rows of traj.h5_output and simulation.h5_output are queued in memory
+# and written to working.hdf5 (through h5cache) by a background thread.
+# The thread takes all the queued writes at once and appends the rows
+# queued for the same dataset with a single write.  The other writes
+# (creating a group, updating attributes, ...) are queued as callables and
+# run in queue order with the rows.  barrier blocks until all the queued
+# writes are in the file: it is called before the file is read, flushed or
+# closed.  An error of the background thread is raised by the next call
+# to append_rows, submit or barrier.
+
+
+class h5_writer(object):
+    """Write-behind queue of the writes to working.hdf5.  With zbackground
+    False the writes are done right away by the thread queueing them.
+    Queueing blocks while max_pending writes are waiting"""
+
+    def __init__(self, zbackground=True, max_pending=4096):
+        self.zbackground = zbackground
+        self.max_pending = max_pending
+        # number of batches and of rows written
+        self.nbatch = 0
+        self.nrows = 0
+
+        self._jobs = []
+        self._busy = False
+        self._error = None
+        self._thread = None
+        self._cond = threading.Condition(threading.Lock())
+
+    def append_rows(self, groupname, rows):
+        """Queue the rows (a list of (dataset name, 1d array) tuples) to be
+        appended to the datasets of the group groupname.  A missing
+        dataset is created with as many columns as its row"""
+
+        self.queue((groupname, rows))
+
+    def submit(self, job):
+        """Queue the callable job, run without arguments holding
+        h5cache.lock after the writes queued before"""
+
+        self.queue(job)
+
+    def queue(self, job):
+        if not self.zbackground:
+            self.barrier()
+            self.write_batch([job])
+            return
+        with self._cond:
+            self.raise_error()
+            while len(self._jobs) >= self.max_pending:
+                self._cond.wait()
+            self._jobs.append(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def barrier(self):
+        """Wait until all the queued writes are done"""
+
+        with self._cond:
+            while len(self._jobs) > 0 or self._busy:
+                self._cond.wait()
+            self.raise_error()
+
+    def raise_error(self):
+        if self._error is not None:
+            (exc_type, exc_value, exc_tb) = self._error
+            self._error = None
+            raise exc_type, exc_value, exc_tb
+
+    def run(self):
+        """Loop of the background thread"""
+
+        while True:
+            with self._cond:
+                while len(self._jobs) == 0:
+                    self._cond.wait()
+                jobs = self._jobs
+                self._jobs = []
+                self._busy = True
+                self._cond.notify_all()
+            error = None
+            try:
+                self.write_batch(jobs)
+            except Exception:
+                error = sys.exc_info()
+            with self._cond:
+                self._busy = False
+                if error is not None and self._error is None:
+                    self._error = error
+                self._cond.notify_all()
+
+    def write_batch(self, jobs):
+        """Do the writes jobs, in order"""
+
+        with h5cache.lock:
+            cache = h5cache.get_cache()
+            pending = OrderedDict()
+            for job in jobs:
+                if isinstance(job, tuple):
+                    (groupname, rows) = job
+                    for (name, row) in rows:
+                        pending.setdefault((groupname, name), []).append(row)
+                else:
+                    self.write_rows(cache, pending)
+                    pending = OrderedDict()
+                    job()
+            self.write_rows(cache, pending)
+            self.nbatch += 1
+
+    def write_rows(self, cache, pending):
+        """Append the rows of pending, by (group name, dataset name), one
+        write per dataset"""
+
+        for (groupname, name) in pending:
+            rows = pending[(groupname, name)]
+            n = rows[0].size
+            dset = cache.get_dataset(groupname, name)
+            if dset is None:
+                h5output.create_dataset(cache.get_group(groupname), name, n)
+                dset = cache.get_dataset(groupname, name)
+            l = h5output.get_length(dset)
+            h5output.set_length(dset, l + len(rows))
+            dset[l:(l + len(rows)), 0:n] = np.vstack(rows)
+            self.nrows += len(rows)
+
+
+# the writer of the process
+_writer = h5_writer()
+
+
+def get_writer():
+    return _writer
+
+
+def set_background(zbackground):
+    """Write in a background thread (zbackground True) or right away"""
+
+    _writer.barrier()
+    _writer.zbackground = zbackground
+
+
+def append_rows(groupname, rows):
+    _writer.append_rows(groupname, rows)
+
+
+def submit(job):
+    _writer.submit(job)
+
+
+def barrier():
+    _writer.barrier()
+
+
+def flush():
+    """Write the queued writes and flush working.hdf5 to the disk"""
+
+    _writer.barrier()
+    h5cache.flush()
+
+
+def close():
+    """Write the queued writes and close working.hdf5"""
+
+    _writer.barrier()
+    h5cache.close()
+
+######################################################
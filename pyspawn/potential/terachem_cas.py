@@ -5,6 +5,8 @@ try:
 except ImportError:
     pass
 import os
+import functools
+from pyspawn import tc_dispatcher
 
 #################################################
 ### electronic structure routines go here #######
@@ -22,10 +24,15 @@ import os
 def compute_elec_struct(self, zbackprop):
     """Subroutine that calls electronic structure calculation in Terachem
     through tcpb interface. This version is compatible with tcpb-0.5.0
+    The TeraChem requests are submitted as one job to the dispatcher of
+    the process (pyspawn.tc_dispatcher), which runs it on the next idle
+    server when the servers have been set with tc_dispatcher.set_servers.
+    Otherwise the job runs on the server on the port of the trajectory or
+    centroid (tc_port), which is passed along to children.  Either way the
+    connections to the servers are kept open between calls.
     When running multiple job on the same server we need to make sure we use
-    different ports for Terachem server. Every trajectory or centroid
-    has a port variable, which is passed along to children.
-    Needs to be provided at input in start file as a traj_param"""
+    different ports for Terachem server.
+    tc_port needs to be provided at input in start file as a traj_param"""
 
     if not zbackprop:
         cbackprop = ""
@@ -44,8 +51,6 @@ def compute_elec_struct(self, zbackprop):
     exec("pos = self.get_" + cbackprop + "positions()")
     pos_list = pos.tolist()
 
-    TC = TCProtobufClient(host='localhost', port=self.tc_port)
-
     base_options = self.get_tc_options()
 
     options = base_options
@@ -54,18 +59,15 @@ def compute_elec_struct(self, zbackprop):
 
 #     TC.update_options(**base_options)
 
-    TC.connect()
-
-    # Check if the server is available
-    avail = TC.is_available()
-#     print "TCPB Server available: {}".format(avail)
-
-    # Write CI vectors and orbitals for initial guess and overlaps
+    # Write CI vectors and orbitals for initial guess and overlaps.  The file
+    # names carry the label of the TBF, since TBFs may be computed at the
+    # same time
     cwd = os.getcwd()
+    csuffix = "." + cbackprop + self.get_label()
     if hasattr(self, 'civecs'):
-        civecout = os.path.join(cwd, "CIvecs.Singlet.old")
-        orbout = os.path.join(cwd, "c0.old")
-        orbout_t = os.path.join(cwd, "c0_t.old")
+        civecout = os.path.join(cwd, "CIvecs.Singlet.old" + csuffix)
+        orbout = os.path.join(cwd, "c0.old" + csuffix)
+        orbout_t = os.path.join(cwd, "c0_t.old" + csuffix)
         eval("self.get_" + cbackprop + "civecs()").tofile(civecout)
         eval("self.get_" + cbackprop + "orbs()").tofile(orbout)
         n = int(math.floor(math.sqrt(self.get_norbs())))
@@ -88,44 +90,33 @@ def compute_elec_struct(self, zbackprop):
         zolaps = False
         options["caswritevecs"] = "yes"
 
-    # Gradient calculation
-
-    # here we call TC once for energies and once for the gradient
-    # will eventually be replaced by a more efficient interface
-    results = TC.compute_job_sync("energy", pos_list, "bohr", **options)
-#     print results
+    if zolaps:
+        exec("pos2 = self.get_" + cbackprop + "prev_wf_positions_in_angstrom()")
+        orbout2 = os.path.join(cwd, "c0.new" + csuffix)
+        olap_files = (pos2.tolist(), civecout, orbout, orbout2)
+        scratch_files = [civecout, orbout, orbout_t, orbout2]
+    else:
+        olap_files = None
+        scratch_files = []
+    tc_job = functools.partial(_tc_job, pos_list=pos_list, options=options,
+                               olap_files=olap_files)
+    try:
+        results = tc_dispatcher.run_job(tc_job, self.tc_port)
+    finally:
+        _remove_files(scratch_files)
 
     e = np.zeros(nstates)
     e = results['energy']
 #    e[:] = results['energy'][:]
 
-    results = TC.compute_job_sync("gradient", pos_list, "bohr", **options)
-#     print results
-
-    civecfilename = os.path.join(results['job_scr_dir'], "CIvecs.Singlet.dat")
-    exec("self.set_" + cbackprop + "civecs(np.fromfile(civecfilename))")
+    exec("self.set_" + cbackprop + "civecs(results['civecs'])")
 #     print "new civecs", self.civecs
 
-#     orbfilename = os.path.join(results['job_scr_dir'], "c0")
-    orbfilename = results['orbfile']
-    exec("self.set_" + cbackprop + "orbs((np.fromfile(orbfilename)).flatten())")
+    exec("self.set_" + cbackprop + "orbs(results['orbs'])")
 
     self.set_norbs(self.get_orbs().size)
 
-    # BGL transpose hack is temporary
-    n = int(math.floor(math.sqrt(self.get_norbs())))
-    clastchar = orbfilename.strip()[-1]
-#     print "n", n
-#     print "clastchar", clastchar
-    if clastchar != '0':
-        tmporbs = eval("self.get_" + cbackprop + "orbs()")
-        exec("self.set_" + cbackprop +
-             "orbs(((tmporbs.reshape((n,n))).T).flatten())")
-    # end transpose hack
-
 #     print "new orbs", eval("self.get_" + cbackprop + "orbs()")
-    orbout2 = os.path.join(cwd, "c0.new")
-    eval("self.get_" + cbackprop + "orbs()").tofile(orbout2)
 
     self.set_ncivecs(self.get_civecs().size)
 
@@ -139,26 +130,7 @@ def compute_elec_struct(self, zbackprop):
 
     # if False:
     if zolaps:
-        exec("pos2 = self.get_" + cbackprop + "prev_wf_positions_in_angstrom()")
-#         print 'pos2.tolist()', pos2.tolist()
-#         print 'civecfilename', civecfilename
-#         print 'civecout', civecout
-#         print 'orbfilename', orbfilename
-#         print 'orbout2', orbout2
-#         print 'orbout', orbout
-        options = base_options
-
-        options["geom2"] = pos2.tolist()
-        options["cvec1file"] = civecfilename
-        options["cvec2file"] = civecout
-        options["orb1afile"] = orbout2
-        options["orb2afile"] = orbout
-
-#         print 'pos_list', pos_list
-        results2 = TC.compute_job_sync("ci_vec_overlap", pos_list,
-                                       "bohr", **options)
-#         print "results2", results2
-        S = results2['ci_overlap']
+        S = results['ci_overlap']
 #         print "S before phasing ", S
 
         # phasing electronic overlaps
@@ -211,38 +183,164 @@ def compute_elec_struct(self, zbackprop):
     exec("self.set_" + cbackprop + "prev_wf_positions(pos)")
 
 
+def _tc_job(TC, pos_list, options, olap_files):
+    """TeraChem requests of compute_elec_struct, run on the connected client
+    TC.  All requests run on the same server, since they read the files
+    written to its scratch directory by the previous ones.  olap_files is
+    None for the first step, otherwise the previous geometry (angstrom) and
+    the files of the previous CI vectors and orbitals, and of the new
+    orbitals.
+    Clients that support it (supports_combined_job, e.g. the stand-in of
+    pyspawn.tc_standin; tcpb has no such job) get the energies, the
+    gradient and the overlaps from a single solve (the
+    "energy_gradient_overlap" job).  Otherwise the energy, gradient and
+    ci_vec_overlap jobs are used"""
+
+    if getattr(TC, "supports_combined_job", False):
+        results = _tc_combined_request(TC, pos_list, options, olap_files)
+        return _tc_combined_results(results, olap_files)
+
+    # here we call TC once for energies and once for the gradient
+    results = TC.compute_job_sync("energy", pos_list, "bohr", **options)
+#     print results
+
+    out = dict()
+    out["energy"] = results['energy']
+
+    # Gradient calculation
+    results = TC.compute_job_sync("gradient", pos_list, "bohr", **options)
+#     print results
+
+    out["gradient"] = results['gradient']
+
+    civecfilename = os.path.join(results['job_scr_dir'], "CIvecs.Singlet.dat")
+    out["civecs"] = np.fromfile(civecfilename)
+
+#     orbfilename = os.path.join(results['job_scr_dir'], "c0")
+    orbfilename = results['orbfile']
+    orbs = (np.fromfile(orbfilename)).flatten()
+
+    # BGL transpose hack is temporary
+    n = int(math.floor(math.sqrt(orbs.size)))
+    clastchar = orbfilename.strip()[-1]
+    if clastchar != '0':
+        orbs = ((orbs.reshape((n, n))).T).flatten()
+    # end transpose hack
+    out["orbs"] = orbs
+
+    if olap_files is not None:
+        (geom2, civecout, orbout, orbout2) = olap_files
+        orbs.tofile(orbout2)
+
+        olap_options = options.copy()
+
+        olap_options["geom2"] = geom2
+        olap_options["cvec1file"] = civecfilename
+        olap_options["cvec2file"] = civecout
+        olap_options["orb1afile"] = orbout2
+        olap_options["orb2afile"] = orbout
+
+        results2 = TC.compute_job_sync("ci_vec_overlap", pos_list,
+                                       "bohr", **olap_options)
+#         print "results2", results2
+        out["ci_overlap"] = results2['ci_overlap']
+
+    return out
+
+
+def _tc_combined_request(TC, pos_list, options, olap_files):
+    """The "energy_gradient_overlap" request: energies, target state
+    gradient, CI vectors, orbitals and the overlaps with the previous CI
+    vectors from one solve"""
+
+    job_options = options.copy()
+    if olap_files is not None:
+        (geom2, civecout, orbout, orbout2) = olap_files
+        job_options["geom2"] = geom2
+        job_options["cvec2file"] = civecout
+        job_options["orb2afile"] = orbout
+
+    return TC.compute_job_sync("energy_gradient_overlap", pos_list,
+                               "bohr", **job_options)
+
+
+def _tc_combined_results(results, olap_files):
+    """Results of compute_elec_struct from the results of the
+    "energy_gradient_overlap" request"""
+
+    out = dict()
+    out["energy"] = results['energy']
+    out["gradient"] = results['gradient']
+
+    civecfilename = os.path.join(results['job_scr_dir'], "CIvecs.Singlet.dat")
+    out["civecs"] = np.fromfile(civecfilename)
+
+    orbfilename = results['orbfile']
+    orbs = (np.fromfile(orbfilename)).flatten()
+
+    # BGL transpose hack is temporary
+    n = int(math.floor(math.sqrt(orbs.size)))
+    clastchar = orbfilename.strip()[-1]
+    if clastchar != '0':
+        orbs = ((orbs.reshape((n, n))).T).flatten()
+    # end transpose hack
+    out["orbs"] = orbs
+
+    if olap_files is not None:
+        out["ci_overlap"] = results['ci_overlap']
+
+    return out
+
 def compute_electronic_overlap(self, pos1, civec1, orbs1, pos2, civec2, orbs2):
-    orbout1 = os.path.join(cwd, "c0.1")
+    """Overlaps of the electronic states with CI vectors civec1 and orbitals
+    orbs1 at pos1 and the states with civec2 and orbs2 at pos2 (bohr)"""
+
+    cwd = os.getcwd()
+    csuffix = "." + self.get_label()
+    orbout1 = os.path.join(cwd, "c0.1" + csuffix)
     orbs1.tofile(orbout1)
-    orbout2 = os.path.join(cwd, "c0.2")
+    orbout2 = os.path.join(cwd, "c0.2" + csuffix)
     orbs2.tofile(orbout2)
 
-    civecout1 = os.path.join(cwd, "civec.1")
+    civecout1 = os.path.join(cwd, "civec.1" + csuffix)
     civec1.tofile(civecout1)
-    civecout2 = os.path.join(cwd, "civec.2")
+    civecout2 = os.path.join(cwd, "civec.2" + csuffix)
     civec2.tofile(civecout2)
 
-    TC = TCProtobufClient(host='localhost', port=self.tc_port)
     options = self.get_tc_options()
-#     TC.update_options(**base_options)
-    TC.connect()
-    # Check if the server is available
-    avail = TC.is_available()
 
     options["geom2"] = (0.529177 * pos2).tolist()
-    options["cvec1file"] = civecfilename
-    options["cvec2file"] = civecout
-    options["orb1afile"] = orbout2
-    options["orb2afile"] = orbout
-
-    results2 = TC.compute_job_sync("ci_vec_overlap", pos1.tolist(),
-                                   "bohr", **options)
+    options["cvec1file"] = civecout1
+    options["cvec2file"] = civecout2
+    options["orb1afile"] = orbout1
+    options["orb2afile"] = orbout2
+
+    tc_job = functools.partial(_tc_request, jobType="ci_vec_overlap",
+                               pos_list=pos1.tolist(), options=options)
+    try:
+        results2 = tc_dispatcher.run_job(tc_job, self.tc_port)
+    finally:
+        _remove_files([orbout1, orbout2, civecout1, civecout2])
 
     S = results2['ci_overlap']
 
     return S
 
 
+def _tc_request(TC, jobType, pos_list, options):
+    """A single TeraChem request, run on the connected client TC"""
+
+    return TC.compute_job_sync(jobType, pos_list, "bohr", **options)
+
+
+def _remove_files(filenames):
+    """Remove the scratch files of a job (the ones that were written)"""
+
+    for filename in filenames:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
 def init_h5_datasets(self):
     self.h5_datasets["time"] = 1
     self.h5_datasets["energies"] = self.numstates
@@ -6,6 +6,8 @@ except ImportError:
     pass
 import os
 import errno
+import functools
+from pyspawn import tc_dispatcher
 
 #################################################
 ### electronic structure routines go here #######
@@ -38,22 +40,31 @@ def compute_elec_struct(self,zbackprop):
     exec("pos = self.get_" + cbackprop + "positions()")
     pos_list = pos.tolist()
         
-    TC = TCProtobufClient(host='localhost', port=54321)
-
     base_options = self.get_tc_options()
 
     base_options["castarget"] = istate
 
-    TC.update_options(**base_options)
+    # the options are the default options of the client, which are only
+    # sent again when they change
+    tc_job = functools.partial(_tc_job, pos_list=pos_list)
+    results = tc_dispatcher.run_job(tc_job, 54321, options=base_options)
+
+    e = np.zeros(nstates)
+    e[0] = results['energy']
+
+    f = np.zeros((nstates,self.numdims))
+    #print "results['gradient'] ", results['gradient']
+    #print "results['gradient'].flatten() ", results['gradient'].flatten()
+    f[self.istate,:] = -1.0 * results['gradient'].flatten()
+
+    exec("self.set_" + cbackprop + "energies(e)")
 
-    TC.connect()
+    exec("self.set_" + cbackprop + "forces(f)")
 
-    # Check if the server is available
-    avail = TC.is_available()
-    #print "TCPB Server available: {}".format(avail)
+def _tc_job(TC, pos_list):
+    """TeraChem requests of compute_elec_struct, run on the connected client
+    TC"""
 
-    # Write CI vectors and orbitals for initial guess and overlaps
-    cwd = os.getcwd()
     # Gradient calculation
 
     # here we call TC once for energies and once for the gradient
@@ -62,20 +73,14 @@ def compute_elec_struct(self,zbackprop):
     results = TC.compute_job_sync("energy", pos_list, "bohr", **options)
     #print results
 
-    e = np.zeros(nstates)
-    e[0] = results['energy']
+    out = dict()
+    out["energy"] = results['energy']
 
     results = TC.compute_job_sync("gradient", pos_list, "bohr", **options)
     #print results
+    out["gradient"] = results['gradient']
 
-    f = np.zeros((nstates,self.numdims))
-    #print "results['gradient'] ", results['gradient']
-    #print "results['gradient'].flatten() ", results['gradient'].flatten()
-    f[self.istate,:] = -1.0 * results['gradient'].flatten()
-
-    exec("self.set_" + cbackprop + "energies(e)")
-
-    exec("self.set_" + cbackprop + "forces(f)")
+    return out
 
 def init_h5_datasets(self):
     self.h5_datasets["time"] = 1
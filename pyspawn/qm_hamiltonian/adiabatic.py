@@ -7,7 +7,11 @@ def build_Heff_first_half(self):
     """Build Heff for the first half of the time step in
     the adibatic rep (with NPI)"""
 
-    self.get_qm_data_from_h5()
+    # S, Sinv, T and Sdot at the current quantum time were already built
+    # for the second half of the previous time step
+    zcached = self.restore_full_step_matrices()
+    if not zcached:
+        self.get_qm_data_from_h5()
 
     qm_time = self.get_quantum_time()
     dt = self.get_timestep()
@@ -15,10 +19,11 @@ def build_Heff_first_half(self):
     self.set_quantum_time_half_step(t_half)
     self.get_qm_data_from_h5_half_step()
 
-    self.build_S()
-    self.invert_S()
-    self.build_Sdot()
-    self.build_H()
+    if not zcached:
+        self.build_S_T_Sdot()
+        self.invert_S()
+        self.cache_full_step_matrices()
+    self.build_H(zbuild_T=False)
 
     self.build_Heff()
 
@@ -27,7 +32,9 @@ def build_Heff_second_half(self):
     """Build Heff for the second half of the time step in
     the adibatic rep (with NPI)"""
 
-    self.get_qm_data_from_h5()
+    zcached = self.restore_full_step_matrices()
+    if not zcached:
+        self.get_qm_data_from_h5()
 
     qm_time = self.get_quantum_time()
     dt = self.get_timestep()
@@ -35,9 +42,10 @@ def build_Heff_second_half(self):
     self.set_quantum_time_half_step(t_half)
     self.get_qm_data_from_h5_half_step()
 
-    self.build_S()
-    self.invert_S()
-    self.build_Sdot()
-    self.build_H()
+    if not zcached:
+        self.build_S_T_Sdot()
+        self.invert_S()
+        self.cache_full_step_matrices()
+    self.build_H(zbuild_T=False)
 
     self.build_Heff()
@@ -20,12 +20,11 @@ def build_Heff_first_half(self):
     self.build_DGAS_coeffs()
     self.build_S_elec_DGAS()
     
-    self.build_S_DGAS()
+    self.build_S_T_Sdot_nuc_DGAS()
     self.invert_S()
-    self.build_Sdot_nuc_DGAS()
     self.build_Sdot_elec_DGAS()
     self.build_Sdot_DGAS()
-    self.build_H_DGAS()
+    self.build_H_DGAS(zbuild_T=False)
     
     self.build_Heff()
         
@@ -44,10 +43,10 @@ def build_Heff_second_half(self):
     self.build_DGAS_coeffs()
     self.build_S_elec_DGAS()
     self.build_Sdot_DGAS()
-    self.build_S_DGAS()
+    self.build_S_T_Sdot_nuc_DGAS(zbuild_Sdot=False)
     self.invert_S()
     self.build_Sdot_DGAS()
-    self.build_H_DGAS()
+    self.build_H_DGAS(zbuild_T=False)
     
     self.build_Heff()
 
@@ -58,10 +57,8 @@ def get_qm_data_from_h5_next_time(self):
     for key in self.traj:
         if self.traj_map[key] < ntraj:
             self.traj[key].get_all_qm_data_at_time_from_h5(qm_time,suffix="_next")
-    for key in self.centroids:
-        key1, key2 = str.split(key,"_a_")
-        if self.traj_map[key1] < ntraj and self.traj_map[key2] < ntraj:
-            self.centroids[key].get_all_qm_data_at_time_from_h5(qm_time,suffix="_next")
+    for key in self.get_active_centroid_keys():
+        self.centroids[key].get_all_qm_data_at_time_from_h5(qm_time,suffix="_next")
 
 # build DGAS coefficients
 def build_DGAS_coeffs(self):
@@ -82,26 +79,16 @@ def build_DGAS_coeffs(self):
     #        self.dgas_coeffs[i,:] = dc[keyi]
     self.dgas_coeffs = np.zeros((ntraj,ntraj,nstat))
     self.dgas_coeffs_next_time = np.zeros((ntraj,ntraj,nstat))
-    for keycent in self.centroids:
-        keyi, keyj = str.split(keycent,"_a_")
-        i = self.traj_map[keyi]
-        j = self.traj_map[keyj]
-        if i < ntraj and j < ntraj:
-            #nstat = self.traj[keyi].get_numstates()
-            ist = self.traj[keyi].get_istate()
-            jst = self.traj[keyj].get_istate()
-            dc = np.zeros(nstat)
-            dc[ist] = 1.0
-            self.dgas_coeffs[i,j,:] = dc
-            dc = np.zeros(nstat)
-            dc[jst] = 1.0
-            self.dgas_coeffs[j,i,:] = dc
-            dc = np.zeros(nstat)
-            dc[ist] = 1.0
-            self.dgas_coeffs_next_time[i,j,:] = dc
-            dc = np.zeros(nstat)
-            dc[jst] = 1.0
-            self.dgas_coeffs_next_time[j,i,:] = dc
+    index = self.get_centroid_index()
+    mask = self.get_active_centroid_mask()
+    ii = index["i"][mask]
+    jj = index["j"][mask]
+    # one-hot vectors of the electronic state of each TBF
+    dc = np.eye(nstat)[self._qm_data["istate"]]
+    self.dgas_coeffs[ii,jj,:] = dc[ii]
+    self.dgas_coeffs[jj,ii,:] = dc[jj]
+    self.dgas_coeffs_next_time[ii,jj,:] = dc[ii]
+    self.dgas_coeffs_next_time[jj,ii,:] = dc[jj]
     #for keycent in self.centroids:
     #    keyi, keyj = str.split(keycent,"_a_")
     #    i = self.traj_map[keyi]
@@ -116,44 +103,43 @@ def build_DGAS_coeffs(self):
 # build matrix of electronic overlaps
 def build_S_elec_DGAS(self):
     ntraj = self.get_num_traj_qm()
-    self.S_elec = np.zeros((ntraj,ntraj))
-    for keyi in self.traj:
-        i = self.traj_map[keyi]
-        if i < ntraj:
-            for keyj in self.traj:
-                j = self.traj_map[keyj]
-                if j < ntraj:
-                    if i == j:
-                        self.S_elec[i,j] = 1.0
-                    else:
-                        Stmp = np.dot(self.dgas_coeffs[i,j,:],self.dgas_coeffs[j,i,:])
-                        self.S_elec[i,j] = Stmp
+    # S_elec[i,j] = dgas_coeffs[i,j,:] . dgas_coeffs[j,i,:]
+    self.S_elec = np.einsum("ijk,jik->ij", self.dgas_coeffs, self.dgas_coeffs)
+    self.S_elec[np.arange(ntraj),np.arange(ntraj)] = 1.0
+
+# compute the nuclear S, T and Sdot matrices from the packed TBF data
+def compute_S_T_Sdot_nuc_DGAS(self):
+    pos = self._qm_data["positions_qm"]
+    mom = self._qm_data["momenta_qm"]
+    forces = self._qm_data["forces_i_qm"]
+    widths = self._qm_data["widths"]
+    masses = self._qm_data["masses"]
+    return cg.overlap_kinetic_Sdot_nuc_matrix(pos, pos, mom, mom, forces, widths, widths, masses)
 
 # build the overlap matrix, S
 def build_S_DGAS(self):
-    ntraj = self.get_num_traj_qm()
-    self.S = np.zeros((ntraj,ntraj), dtype=np.complex128)
-    self.S_nuc = np.zeros((ntraj,ntraj), dtype=np.complex128)
-    for keyi in self.traj:
-        i = self.traj_map[keyi]
-        if i < ntraj:
-            for keyj in self.traj:
-                j = self.traj_map[keyj]
-                if j < ntraj:
-                    self.S_nuc[i,j] = cg.overlap_nuc(self.traj[keyi], self.traj[keyj],positions_i="positions_qm",positions_j="positions_qm",momenta_i="momenta_qm",momenta_j="momenta_qm") 
-                    self.S[i,j] = self.S_nuc[i,j] * self.S_elec[i,j]
+    pos = self._qm_data["positions_qm"]
+    mom = self._qm_data["momenta_qm"]
+    widths = self._qm_data["widths"]
+    self.S_nuc = cg.overlap_nuc_matrix(pos, pos, mom, mom, widths, widths)
+    self.S = self.S_nuc * self.S_elec
+    # the DGAS electronic overlaps couple all states, S is dense
+    self._state_blocks = None
 
 # build the right-acting time derivative operator
 def build_Sdot_nuc_DGAS(self):
-    ntraj = self.get_num_traj_qm()
-    self.Sdot_nuc = np.zeros((ntraj,ntraj), dtype=np.complex128)
-    for keyi in self.traj:
-        i = self.traj_map[keyi]
-        if i < ntraj:
-            for keyj in self.traj:
-                j = self.traj_map[keyj]
-                if j < ntraj:
-                    self.Sdot_nuc[i,j] = cg.Sdot_nuc(self.traj[keyi], self.traj[keyj],positions_i="positions_qm",positions_j="positions_qm",momenta_i="momenta_qm",momenta_j="momenta_qm",forces_j="forces_i_qm") * self.S_elec[i,j]
+    self.Sdot_nuc = self.compute_S_T_Sdot_nuc_DGAS()[2] * self.S_elec
+
+# build S, the kinetic energy matrix T and (if zbuild_Sdot) the nuclear part
+# of Sdot in a single pass that shares the 1D Gaussian overlap factors.
+# Equivalent to build_S_DGAS, build_T_DGAS and build_Sdot_nuc_DGAS
+def build_S_T_Sdot_nuc_DGAS(self, zbuild_Sdot=True):
+    self.S_nuc, T_nuc, Sdot_nuc = self.compute_S_T_Sdot_nuc_DGAS()
+    self.S = self.S_nuc * self.S_elec
+    self._state_blocks = None
+    self.T = T_nuc * self.S_elec
+    if zbuild_Sdot:
+        self.Sdot_nuc = Sdot_nuc * self.S_elec
 
 def build_Sdot_elec_DGAS(self):
     ntraj = self.get_num_traj_qm()    
@@ -290,14 +276,16 @@ def build_Sdot_DGAS(self):
     self.Sdot = self.Sdot_nuc + self.Sdot_elec
 
 # build the Hamiltonian matrix, H
-# This routine assumes that S is already built
-def build_H_DGAS(self):
+# This routine assumes that S is already built (and T as well if
+# zbuild_T is False)
+def build_H_DGAS(self, zbuild_T=True):
     print "# building potential energy matrix"
     self.build_V_DGAS()
     print "# building NAC matrix"
     #self.build_tau_DGAS()
-    print "# building kinetic energy matrix"
-    self.build_T_DGAS()
+    if zbuild_T:
+        print "# building kinetic energy matrix"
+        self.build_T_DGAS()
     ntraj = self.get_num_traj_qm()
     shift = self.get_qm_energy_shift() * np.identity(ntraj)
     print "# summing Hamiltonian"
@@ -311,26 +299,17 @@ def build_V_DGAS(self):
     cm1i = (complex(0.0,-1.0))
     ntraj = self.get_num_traj_qm()
     self.V = np.zeros((ntraj,ntraj),dtype=np.complex128)
-    for key in self.traj:
-        i = self.traj_map[key]
-        istate = self.traj[key].get_istate()
-        if i < ntraj:
-            self.V[i,i] = self.traj[key].get_energies_qm()[istate]
-    for key in self.centroids:
-        keyi, keyj = str.split(key,"_a_")
-        i = self.traj_map[keyi]
-        j = self.traj_map[keyj]
-        if i < ntraj and j < ntraj:
-            istate = self.centroids[key].get_istate()
-            jstate = self.centroids[key].get_jstate()
-            nstates = self.centroids[key].get_numstates()
-            #if istate == jstate:
-            #BGL this is not correct and must be fixed later
-            E = self.centroids[key].get_energies_qm()
-            for ist in range(nstates):
-                Etmp = self.dgas_coeffs[i,j,ist] * self.dgas_coeffs[j,i,ist] * E[ist]
-                self.V[i,j] += Etmp * self.S_nuc[i,j]
-                self.V[j,i] += Etmp * self.S_nuc[j,i]
+    diag = np.arange(ntraj)
+    self.V[diag,diag] = self._qm_data["energies_qm"][diag,self._qm_data["istate"]]
+    index = self.get_centroid_index()
+    mask = self.get_active_centroid_mask()
+    ii = index["i"][mask]
+    jj = index["j"][mask]
+    #BGL this is not correct and must be fixed later
+    E = self._qm_data["centroid_energies_qm"][mask]
+    Etmp = np.sum(self.dgas_coeffs[ii,jj,:] * self.dgas_coeffs[jj,ii,:] * E, axis=1)
+    np.add.at(self.V, (ii,jj), Etmp * self.S_nuc[ii,jj])
+    np.add.at(self.V, (jj,ii), Etmp * self.S_nuc[jj,ii])
 
                 
 # build the nonadiabatic coupling matrix, tau
@@ -356,13 +335,4 @@ def build_V_DGAS(self):
                 
 # build the kinetic energy matrix, T
 def build_T_DGAS(self):
-    ntraj = self.get_num_traj_qm()
-    self.T = np.zeros((ntraj,ntraj), dtype=np.complex128)
-    for keyi in self.traj:
-        i = self.traj_map[keyi]
-        if i < ntraj:
-            for keyj in self.traj:
-                j = self.traj_map[keyj]
-                if j < ntraj:
-                    self.T[i,j] = cg.kinetic_nuc(self.traj[keyi], self.traj[keyj],positions_i="positions_qm",positions_j="positions_qm",momenta_i="momenta_qm",momenta_j="momenta_qm") * self.S_elec[i,j]
-
+    self.T = self.compute_S_T_Sdot_nuc_DGAS()[1] * self.S_elec
@@ -1,3 +1,6 @@
 import pyspawn.qm_integrator.rk2
 import pyspawn.qm_integrator.fulldiag
-
+import pyspawn.qm_integrator.krylov
+import pyspawn.qm_integrator.pade
+import pyspawn.qm_integrator.rk45
+import pyspawn.qm_integrator.magnus
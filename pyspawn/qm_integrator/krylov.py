@@ -0,0 +1,99 @@
+import numpy as np
+import numpy.linalg as la
+from pyspawn.qm_integrator import pade
+
+######################################################
+# Krylov subspace (Arnoldi) quantum integrator
+######################################################
+
+def qm_propagate_step(self,zoutput_first_step=False):
+    self.compute_num_traj_qm()
+    qm_t = self.get_quantum_time()
+    dt = self.get_timestep()
+    qm_tpdt = qm_t + dt
+
+    amps_t = self.get_qm_amplitudes()
+
+    self.build_Heff_first_half()
+
+    # output the first step before propagating
+    if zoutput_first_step:
+        self.h5_output()
+
+    amps = self.krylov_expmv(0.5 * dt, amps_t)
+
+    self.set_quantum_time(qm_tpdt)
+
+    self.build_Heff_second_half()
+
+    amps = self.krylov_expmv(0.5 * dt, amps)
+
+    self.set_qm_amplitudes(amps)
+
+# apply exp(-i Heff t) to the amplitude vector amps.  The Krylov subspace
+# spanned by amps, (-i Heff) amps, ... is grown by Arnoldi iterations until
+# the error estimate drops below krylov_tol.  If the subspace reaches
+# krylov_maxdim first, t is split into substeps that are short enough.
+def krylov_expmv(self,t,amps):
+    c1i = (complex(0.0,1.0))
+    tol = self.get_krylov_tol()
+    n = len(amps)
+    maxdim = min(self.get_krylov_maxdim(), n)
+    amps = np.asarray(amps, dtype=np.complex128)
+
+    t_done = 0.0
+    tau = t
+    nsubstep = 0
+    dim = 0
+    error = 0.0
+    while t - t_done > 1.0e-12 * t:
+        tau = min(tau, t - t_done)
+        beta = la.norm(amps)
+        if beta == 0.0:
+            break
+        V = np.zeros((n, maxdim + 1), dtype=np.complex128)
+        Hm = np.zeros((maxdim + 1, maxdim), dtype=np.complex128)
+        V[:,0] = amps / beta
+        for m in range(maxdim):
+            # Arnoldi step with modified Gram-Schmidt
+            w = -1.0 * c1i * np.matmul(self.Heff, V[:,m])
+            for k in range(m + 1):
+                Hm[k,m] = np.vdot(V[:,k], w)
+                w = w - Hm[k,m] * V[:,k]
+            Hm[m+1,m] = la.norm(w)
+            dim = m + 1
+            if abs(Hm[m+1,m]) < 1.0e-12:
+                # happy breakdown: the subspace is invariant, the result
+                # is exact
+                expH = _expm_small(tau * Hm[:dim,:dim])
+                error = 0.0
+                break
+            V[:,m+1] = w / Hm[m+1,m]
+            expH = _expm_small(tau * Hm[:dim,:dim])
+            error = beta * tau * abs(Hm[dim,dim-1]) * abs(expH[dim-1,0])
+            if error < tol:
+                break
+        # the subspace is as large as allowed, shorten the substep instead
+        while error >= tol:
+            tau *= 0.5
+            expH = _expm_small(tau * Hm[:dim,:dim])
+            error = beta * tau * abs(Hm[dim,dim-1]) * abs(expH[dim-1,0])
+        amps = beta * np.matmul(V[:,:dim], expH[:,0])
+        t_done += tau
+        nsubstep += 1
+        # try a longer substep next
+        tau *= 2.0
+
+    print "# Krylov integrator: subspace dimension = ", dim, ", substeps = ", nsubstep, \
+        ", error estimate = ", error
+
+    return amps
+
+# exponential of a small (Krylov subspace) matrix.  The Hessenberg matrix
+# of the Arnoldi iterations is not normal in general, so it is
+# exponentiated by scaling and squaring rather than through its
+# eigenvectors
+def _expm_small(A):
+    return pade._expm_pade(A, pade._new_workspace(A.shape[0]))
+
+######################################################
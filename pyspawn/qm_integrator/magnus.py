@@ -0,0 +1,57 @@
+import numpy as np
+import math
+from pyspawn.qm_integrator import pade
+
+######################################################
+# 4th order commutator-free Magnus quantum integrator
+######################################################
+
+# Gauss-Legendre nodes of the step and the weights of the two exponentials
+# of the commutator-free 4th order Magnus expansion (Blanes and Moan 2006)
+_c1 = 0.5 - math.sqrt(3.0) / 6.0
+_c2 = 0.5 + math.sqrt(3.0) / 6.0
+_alpha1 = 0.25 + math.sqrt(3.0) / 6.0
+_alpha2 = 0.25 - math.sqrt(3.0) / 6.0
+
+# Heff is built at the beginning and at the end of the step (the two half
+# step Hamiltonians) and interpolated linearly to the Gauss-Legendre nodes.
+# The amplitudes are then propagated over the full step with two
+# exponentials of combinations of the interpolated Hamiltonians, instead of
+# treating each half step Hamiltonian as constant over its half step
+def qm_propagate_step(self,zoutput_first_step=False):
+    c1i = (complex(0.0,1.0))
+    self.compute_num_traj_qm()
+    qm_t = self.get_quantum_time()
+    dt = self.get_timestep()
+    qm_tpdt = qm_t + dt
+    ntraj = self.get_num_traj_qm()
+
+    amps_t = self.get_qm_amplitudes()
+
+    self.build_Heff_first_half()
+
+    # output the first step before propagating
+    if zoutput_first_step:
+        self.h5_output()
+
+    Heff_t = self.Heff
+
+    self.set_quantum_time(qm_tpdt)
+
+    self.build_Heff_second_half()
+
+    Heff_tpdt = self.Heff
+
+    dHeff = Heff_tpdt - Heff_t
+    H1 = Heff_t + _c1 * dHeff
+    H2 = Heff_t + _c2 * dHeff
+
+    work = pade._get_workspace(self, ntraj)
+    iHdt = (-1.0 * dt * c1i) * (_alpha1 * H1 + _alpha2 * H2)
+    amps = np.matmul(pade._expm_pade(iHdt, work), amps_t)
+    iHdt = (-1.0 * dt * c1i) * (_alpha2 * H1 + _alpha1 * H2)
+    amps = np.matmul(pade._expm_pade(iHdt, work), amps)
+
+    self.set_qm_amplitudes(amps)
+
+######################################################
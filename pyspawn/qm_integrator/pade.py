@@ -0,0 +1,119 @@
+import numpy as np
+import numpy.linalg as la
+import math
+
+######################################################
+# scaling-and-squaring Pade quantum integrator
+######################################################
+
+# coefficients of the [13/13] Pade approximant of exp and the 1-norm
+# below which it is accurate to double precision (Higham 2005)
+_pade13 = [64764752532480000.0, 32382376266240000.0, 7771770303897600.0,
+           1187353796428800.0, 129060195264000.0, 10559470521600.0,
+           670442572800.0, 33522128640.0, 1323241920.0, 40840800.0,
+           960960.0, 16380.0, 182.0, 1.0]
+_theta13 = 5.371920351148152
+
+def qm_propagate_step(self,zoutput_first_step=False):
+    c1i = (complex(0.0,1.0))
+    self.compute_num_traj_qm()
+    qm_t = self.get_quantum_time()
+    dt = self.get_timestep()
+    qm_tpdt = qm_t + dt
+    ntraj = self.get_num_traj_qm()
+
+    amps_t = self.get_qm_amplitudes()
+
+    self.build_Heff_first_half()
+
+    # the norm drift is written to the output from the first step on
+    if self.get_qm_norm_drift() is None:
+        self.set_qm_norm_drift(0.0)
+
+    # output the first step before propagating
+    if zoutput_first_step:
+        self.h5_output()
+
+    norm_t = np.vdot(amps_t, np.matmul(self.S, amps_t)).real
+
+    # the workspace is shared by both half steps (and by all steps with the
+    # same number of TBFs)
+    work = _get_workspace(self, ntraj)
+
+    iHdt = (-0.5 * dt * c1i) * self.Heff
+    amps = np.matmul(_expm_pade(iHdt, work), amps_t)
+
+    self.set_quantum_time(qm_tpdt)
+
+    self.build_Heff_second_half()
+
+    iHdt = (-0.5 * dt * c1i) * self.Heff
+    amps = np.matmul(_expm_pade(iHdt, work), amps)
+
+    norm_tpdt = np.vdot(amps, np.matmul(self.S, amps)).real
+    self.set_qm_norm_drift(float(norm_tpdt - norm_t))
+
+    self.set_qm_amplitudes(amps)
+
+# return the Pade workspace (a dict of ntraj x ntraj complex arrays),
+# allocating it only when the number of TBFs has changed
+def _get_workspace(self, ntraj):
+    work = self._pade_work
+    if work is None or work["ident"].shape[0] != ntraj:
+        work = _new_workspace(ntraj)
+        self._pade_work = work
+    return work
+
+# allocate a Pade workspace for n x n matrices
+def _new_workspace(n):
+    work = dict()
+    for name in ["A2", "A4", "A6", "U", "V", "tmp"]:
+        work[name] = np.zeros((n, n), dtype=np.complex128)
+    work["ident"] = np.identity(n, dtype=np.complex128)
+    return work
+
+# exponential of the matrix A by scaling and squaring with the [13/13] Pade
+# approximant.  The products are written into the arrays of work
+def _expm_pade(A, work):
+    b = _pade13
+    ident = work["ident"]
+    A2 = work["A2"]
+    A4 = work["A4"]
+    A6 = work["A6"]
+    U = work["U"]
+    V = work["V"]
+    tmp = work["tmp"]
+
+    # scale A such that its 1-norm is below theta13
+    norm1 = np.max(np.sum(np.absolute(A), axis=0)) if A.size > 0 else 0.0
+    s = 0
+    if norm1 > _theta13:
+        s = int(math.ceil(math.log(norm1 / _theta13, 2.0)))
+    A = A / (2.0 ** s)
+
+    np.dot(A, A, out=A2)
+    np.dot(A2, A2, out=A4)
+    np.dot(A4, A2, out=A6)
+
+    # odd part U and even part V of the numerator
+    tmp[:] = b[13] * A6 + b[11] * A4 + b[9] * A2
+    np.dot(A6, tmp, out=U)
+    U += b[7] * A6 + b[5] * A4 + b[3] * A2 + b[1] * ident
+    np.dot(A, U, out=tmp)
+    U[:] = tmp
+
+    tmp[:] = b[12] * A6 + b[10] * A4 + b[8] * A2
+    np.dot(A6, tmp, out=V)
+    V += b[6] * A6 + b[4] * A4 + b[2] * A2 + b[0] * ident
+
+    # r = (V - U)^-1 (V + U)
+    r = la.solve(V - U, V + U)
+
+    # undo the scaling by repeated squaring
+    for i in range(s):
+        np.dot(r, r, out=tmp)
+        r[:] = tmp
+
+    return r
+
+######################################################
@@ -0,0 +1,105 @@
+import numpy as np
+import math
+
+######################################################
+# embedded Runge-Kutta (Dormand-Prince 5(4)) quantum integrator
+######################################################
+
+# Dormand-Prince tableau
+_c = [0.0, 1.0 / 5.0, 3.0 / 10.0, 4.0 / 5.0, 8.0 / 9.0, 1.0, 1.0]
+_a = [[],
+      [1.0 / 5.0],
+      [3.0 / 40.0, 9.0 / 40.0],
+      [44.0 / 45.0, -56.0 / 15.0, 32.0 / 9.0],
+      [19372.0 / 6561.0, -25360.0 / 2187.0, 64448.0 / 6561.0, -212.0 / 729.0],
+      [9017.0 / 3168.0, -355.0 / 33.0, 46732.0 / 5247.0, 49.0 / 176.0, -5103.0 / 18656.0],
+      [35.0 / 384.0, 0.0, 500.0 / 1113.0, 125.0 / 192.0, -2187.0 / 6784.0, 11.0 / 84.0]]
+# 5th order weights (equal to the last row of _a) and the difference to the
+# embedded 4th order weights
+_b = [35.0 / 384.0, 0.0, 500.0 / 1113.0, 125.0 / 192.0, -2187.0 / 6784.0, 11.0 / 84.0, 0.0]
+_e = [71.0 / 57600.0, 0.0, -71.0 / 16695.0, 71.0 / 1920.0, -17253.0 / 339200.0, 22.0 / 525.0,
+      -1.0 / 40.0]
+
+def qm_propagate_step(self,zoutput_first_step=False):
+    self.compute_num_traj_qm()
+    qm_t = self.get_quantum_time()
+    dt = self.get_timestep()
+    qm_tpdt = qm_t + dt
+
+    amps_t = self.get_qm_amplitudes()
+
+    self.build_Heff_first_half()
+
+    # output the first step before propagating
+    if zoutput_first_step:
+        self.h5_output()
+
+    amps = self.rk45_integrate(0.5 * dt, amps_t)
+
+    self.set_quantum_time(qm_tpdt)
+
+    self.build_Heff_second_half()
+
+    amps = self.rk45_integrate(0.5 * dt, amps)
+
+    self.set_qm_amplitudes(amps)
+
+# integrate d amps / dt = -i Heff amps over the time t with adaptive
+# Dormand-Prince substeps.  The first substep is the last accepted substep
+# size of the previous call (rk45_substep), and the local error of every
+# substep is kept below rk45_tol (mixed absolute/relative error)
+def rk45_integrate(self,t,amps):
+    c1i = (complex(0.0,1.0))
+    tol = self.get_rk45_tol()
+    amps = np.asarray(amps, dtype=np.complex128)
+
+    h = self.get_rk45_substep()
+    if h <= 0.0:
+        h = t
+    t_done = 0.0
+    nsubstep = 0
+    nreject = 0
+    k = [None] * 7
+    k[0] = -1.0 * c1i * np.matmul(self.Heff, amps)
+    while t - t_done > 1.0e-12 * t:
+        hstep = min(h, t - t_done)
+        for i in range(1, 7):
+            tmp = amps.copy()
+            for j in range(i):
+                if _a[i][j] != 0.0:
+                    tmp += (hstep * _a[i][j]) * k[j]
+            k[i] = -1.0 * c1i * np.matmul(self.Heff, tmp)
+        # the 5th order solution is the last stage (first same as last)
+        amps_new = tmp
+        err_vec = hstep * sum(_e[i] * k[i] for i in range(7) if _e[i] != 0.0)
+        scale = tol + tol * np.maximum(np.absolute(amps), np.absolute(amps_new))
+        error = math.sqrt(np.mean(np.absolute(err_vec / scale) ** 2))
+
+        if error <= 1.0:
+            t_done += hstep
+            amps = amps_new
+            k[0] = k[6]
+            nsubstep += 1
+            # keep the proposed size of the next substep
+            if error == 0.0:
+                fac = 5.0
+            else:
+                fac = min(5.0, max(0.2, 0.9 * error ** -0.2))
+            if hstep == h:
+                h = h * fac
+            else:
+                # the substep was shortened to end at t
+                h = max(h, hstep * fac)
+        else:
+            nreject += 1
+            h = hstep * max(0.2, 0.9 * error ** -0.2)
+
+    self.set_rk45_substep(h)
+    self.set_rk45_nsubstep(self.get_rk45_nsubstep() + nsubstep)
+    self.set_rk45_nreject(self.get_rk45_nreject() + nreject)
+    print "# in RK45 integrator, substeps = ", nsubstep, ", rejected = ", nreject, \
+        ", next substep = ", h
+
+    return amps
+
+######################################################
@@ -1,14 +1,24 @@
 import types
 import numpy as np
-import h5py
 from pyspawn.fmsobj import fmsobj
 from pyspawn.traj import traj
+from pyspawn.task import task
+from pyspawn import h5output
+from pyspawn import h5cache
+from pyspawn import h5writer
 import general as gen
 import os
 import shutil
 import complexgaussian as cg
 import datetime
 import time
+import heapq
+import functools
+from multiprocessing.pool import ThreadPool
+try:
+    import scipy.linalg as spl
+except ImportError:
+    spl = None
 
 
 class simulation(fmsobj):
@@ -23,10 +33,19 @@ class simulation(fmsobj):
         # between the basis functions
         self.centroids = dict()
 
-        # queue is a list of tasks to be run
-        self.queue = ["END"]
-        # tasktimes is a list of the simulation times associated with each task
-        self.tasktimes = [1e10]
+        # the task queue is a binary heap of (unblock time, -depth, number,
+        # task) entries (see pyspawn.task and the ordering heuristic of
+        # task_priority), updated incrementally: trajectory tasks are
+        # pushed when a trajectory is added or one of its tasks is done,
+        # centroid tasks when update_centroids finds them computable.
+        # _task_ids holds the ids of the queued tasks and _task_counter
+        # keeps tasks of equal priority in the order they were queued
+        self._task_heap = []
+        self._task_ids = set()
+        self._task_counter = 0
+        # False until the queue has been filled from all trajectories (at
+        # the start or after a restart)
+        self._task_heap_ready = False
 
         # olapmax is the maximum overlap allowed for a spawn.  Above this,
         # the spawn is cancelled
@@ -65,6 +84,80 @@ class simulation(fmsobj):
         # maximium walltime in seconds
         self.max_walltime = -1.0
 
+        # how S is inverted: "inv" inverts its diagonal blocks, "cholesky" and
+        # "canonical" keep a factorization of S and obtain Heff through
+        # solves.  Canonical orthogonalization drops the directions with
+        # overlap eigenvalues below S_canonical_thresh
+        self.S_factorization = "inv"
+        self.S_canonical_thresh = 1.0e-6
+        # number of directions dropped by the canonical orthogonalizations
+        self.S_canonical_ndrop = 0
+
+        # TBF pairs whose overlap is bounded below pair_screen_thresh (from
+        # their phase-space distance) are not computed and left zero.  A
+        # threshold of 0.0 switches the screening off
+        self.pair_screen_thresh = 0.0
+
+        # error tolerance and maximum subspace dimension of the Krylov
+        # quantum integrator
+        self.krylov_tol = 1.0e-10
+        self.krylov_maxdim = 20
+
+        # change of the norm of the amplitudes (in the metric S) over the
+        # last quantum step, recorded by the pade integrator and written
+        # to the sim datasets of the h5 output.  None (and not written)
+        # with the other integrators
+        self.qm_norm_drift = None
+
+        # local error tolerance of the rk45 integrator, the substep size
+        # carried over from the previous quantum step (0.0 to start with
+        # a full half step) and the running counts of accepted and
+        # rejected substeps
+        self.rk45_tol = 1.0e-8
+        self.rk45_substep = 0.0
+        self.rk45_nsubstep = 0
+        self.rk45_nreject = 0
+
+        # number of worker threads used to run the ready propagation tasks
+        # at the same time level concurrently.  With 1, a single task is
+        # run per cycle
+        self.num_workers = 1
+
+        # filters of the hdf5 output datasets (compression None, "gzip" or
+        # "lzf", the gzip level and the shuffle filter) and the size of
+        # their chunks in bytes, see h5output.set_options
+        self.h5_compression = None
+        self.h5_compression_opts = None
+        self.h5_shuffle = False
+        self.h5_chunk_bytes = 65536
+        # whether the hdf5 output is written by a background thread (see
+        # h5writer) or right away
+        self.h5_write_behind = False
+
+        # matrix indices of the TBFs on each electronic state, and the
+        # inverses/factorizations of the corresponding diagonal blocks of
+        # S.  _state_blocks is None if S is not block diagonal (DGAS)
+        self._state_blocks = None
+        self._S_factors = dict()
+
+        # packed full time step data of the TBFs in the quantum propagation
+        # (see pack_qm_data)
+        self._qm_data = dict()
+
+        # integer index arrays describing the centroids (see
+        # get_centroid_index), rebuilt when TBFs or centroids are added
+        self._centroid_index = None
+
+        # full time step matrices kept for reuse across the half step
+        # boundary of the quantum propagator
+        self._full_step_cache = None
+
+        # matrix workspace of the pade integrator
+        self._pade_work = None
+
+        # thread pool for parallel task execution (see num_workers)
+        self._pool = None
+
     def from_dict(self, **tempdict):
         """Convert dict to simulation data structure"""
 
@@ -138,19 +231,66 @@ class simulation(fmsobj):
             index = len(self.traj)
         self.traj[key] = t1
         self.traj_map[key] = index
+        self._centroid_index = None
+        if self._task_heap_ready:
+            self.add_traj_tasks(key)
         # sort traj_map by mintime
 
     def get_num_traj(self):
         """Get number of trajectories"""
         return len(self.traj)
 
-    def add_task(self, task):
-        """Add a task to the queue"""
-        self.queue.append(task)
+    def add_task(self, t):
+        """Add a task to the queue, unless it is queued already"""
+        if t.get_id() in self._task_ids:
+            return
+        unblock_time, depth = self.task_priority(t)
+        heapq.heappush(self._task_heap, (unblock_time, -depth, self._task_counter, t))
+        self._task_counter += 1
+        self._task_ids.add(t.get_id())
+
+    def task_priority(self, t):
+        """Ordering heuristic for the task queue (there is no dependency
+        graph of the tasks).  The quantum propagation can only advance to
+        the minimum time for which all TBFs have their data (see
+        propagate_quantum_as_necessary), and trajectory steps are followed
+        by the centroid steps between the trajectory and the other TBFs.
+        Returns (unblock_time, depth): the time up to which the task holds
+        back the quantum propagation (the task's time for forward steps,
+        the mintime of the TBF for backward propagation, which has to be
+        completed before the quantum propagation can pass mintime) and an
+        estimate of the number of steps left before that (the remaining
+        backward steps, plus one for the centroid steps).  Tasks are run
+        by increasing unblock time and then decreasing depth"""
+
+        tbf = getattr(self, t.target)[t.key]
+        if t.zbackprop:
+            unblock_time = tbf.get_mintime()
+            # the remaining backward steps of this TBF
+            depth = int(round((t.time - tbf.get_mintime()) / tbf.get_timestep()))
+        else:
+            unblock_time = t.time
+            depth = 1
+        # trajectory steps are followed by the centroid steps
+        if t.target == "traj" and self.get_num_traj() > 1:
+            depth += 1
+        return unblock_time, depth
+
+    def add_traj_tasks(self, key):
+        """Add the forward and backward propagation tasks of a trajectory
+        to the queue, if it still has to be propagated"""
+
+        tr = self.traj[key]
+        # forward propagation
+        if (tr.get_maxtime() + 1.0e-6) > tr.get_time():
+            self.add_task(task("traj", key, False, tr.get_time()))
+        # backward propagation
+        if (tr.get_mintime() + 1.0e-6) < tr.get_backprop_time():
+            self.add_task(task("traj", key, True, tr.get_backprop_time()))
 
     def get_numtasks(self):
         """Get the number of tasks in the queue"""
-        return (len(self.queue)-1)
+        return len(self._task_heap)
 
     def set_olapmax(self, s):
         self.olapmax = s
@@ -281,12 +421,134 @@ class simulation(fmsobj):
         return self.Sdot.copy()
 
     def get_Sinv(self):
+        # Sinv is only formed from the blocks of S when needed
+        if self.Sinv is None:
+            self.Sinv = np.zeros_like(self.S)
+            blocks = self.get_S_blocks()
+            for key in blocks:
+                nblock = len(blocks[key])
+                self.Sinv[np.ix_(blocks[key], blocks[key])] = self.solve_S_block(
+                    self._S_factors[key], np.identity(nblock, dtype=np.complex128))
         return self.Sinv.copy()
 
+    def get_S_factorization(self):
+        return self.S_factorization
+
+    def set_S_factorization(self, f):
+        """Set how S enters Heff: "inv" (explicit inverse), "cholesky"
+        (Cholesky factorization and triangular solves) or "canonical"
+        (canonical orthogonalization)"""
+
+        if f not in ["inv", "cholesky", "canonical"]:
+            print "### S_factorization must be inv, cholesky or canonical, exiting"
+            quit()
+        self.S_factorization = f
+
+    def get_S_canonical_thresh(self):
+        return self.S_canonical_thresh
+
+    def set_S_canonical_thresh(self, t):
+        self.S_canonical_thresh = t
+
+    def get_S_canonical_ndrop(self):
+        return self.S_canonical_ndrop
+
+    def set_S_canonical_ndrop(self, n):
+        self.S_canonical_ndrop = n
+
+    def get_pair_screen_thresh(self):
+        return self.pair_screen_thresh
+
+    def set_pair_screen_thresh(self, t):
+        self.pair_screen_thresh = t
+
+    def get_krylov_tol(self):
+        return self.krylov_tol
+
+    def set_krylov_tol(self, t):
+        self.krylov_tol = t
+
+    def get_krylov_maxdim(self):
+        return self.krylov_maxdim
+
+    def set_krylov_maxdim(self, m):
+        self.krylov_maxdim = m
+
+    def get_qm_norm_drift(self):
+        return self.qm_norm_drift
+
+    def set_qm_norm_drift(self, d):
+        self.qm_norm_drift = d
+
+    def get_rk45_tol(self):
+        return self.rk45_tol
+
+    def set_rk45_tol(self, t):
+        self.rk45_tol = t
+
+    def get_rk45_substep(self):
+        return self.rk45_substep
+
+    def set_rk45_substep(self, h):
+        self.rk45_substep = h
+
+    def get_rk45_nsubstep(self):
+        return self.rk45_nsubstep
+
+    def set_rk45_nsubstep(self, n):
+        self.rk45_nsubstep = n
+
+    def get_rk45_nreject(self):
+        return self.rk45_nreject
+
+    def set_rk45_nreject(self, n):
+        self.rk45_nreject = n
+
+    def get_num_workers(self):
+        return self.num_workers
+
+    def set_num_workers(self, n):
+        self.num_workers = n
+
+    def get_h5_compression(self):
+        return self.h5_compression
+
+    def set_h5_compression(self, c):
+        self.h5_compression = c
+
+    def get_h5_compression_opts(self):
+        return self.h5_compression_opts
+
+    def set_h5_compression_opts(self, opts):
+        self.h5_compression_opts = opts
+
+    def get_h5_shuffle(self):
+        return self.h5_shuffle
+
+    def set_h5_shuffle(self, z):
+        self.h5_shuffle = z
+
+    def get_h5_chunk_bytes(self):
+        return self.h5_chunk_bytes
+
+    def set_h5_chunk_bytes(self, n):
+        self.h5_chunk_bytes = n
+
+    def get_h5_write_behind(self):
+        return self.h5_write_behind
+
+    def set_h5_write_behind(self, z):
+        self.h5_write_behind = z
+
     def propagate(self):
         """This is the main propagation loop for the simulation"""
 
         gen.print_splash()
+        h5output.set_options(compression=self.get_h5_compression(),
+                             compression_opts=self.get_h5_compression_opts(),
+                             shuffle=self.get_h5_shuffle(),
+                             chunk_bytes=self.get_h5_chunk_bytes())
+        h5writer.set_background(self.get_h5_write_behind())
         while True:
             # compute centroid positions and mark those centroids that
             # can presently be computed
@@ -303,27 +565,38 @@ class simulation(fmsobj):
             if (self.get_quantum_time() + 1.0e-6 > self.get_max_quantum_time()):
                 print "### propagate DONE, simulation ended gracefully!"
                 print "Removing working.hdf5, sim.1.hdf5 and sim.1.json files"
+                self.close_pool()
+                h5writer.close()
                 os.remove('working.hdf5')
                 os.remove('sim.1.hdf5')
                 os.remove('sim.1.json')
+                # release the preallocated rows of the final output
+                h5output.trim_file('sim.hdf5')
                 return
 
             # end simulation if walltime has expired
             print "### checking if maximum wall time is reached"
             if (self.get_max_walltime() < time.time() and self.get_max_walltime() > 0):
                 print "### wall time expired, simulation ended gracefully!"
+                self.close_pool()
+                h5writer.close()
+                # release the preallocated rows of the restart output
+                h5output.trim_file('sim.hdf5')
                 return
 
             # it is possible for the queue to run empty but for the job not
             # to be done
-            if (self.queue[0] != "END"):
-                # Right now we just run a single task per cycle,
-                # but we could parallelize here and send multiple tasks
-                # out for simultaneous processing.
-                current = self.pop_task()
-                print "### starting " + current
-                eval(current)
-                print "### done with " + current
+            if self.get_numtasks() > 0:
+                if self.get_num_workers() > 1:
+                    # run the first num_workers tasks concurrently
+                    self.run_tasks_parallel(self.pop_ready_tasks())
+                else:
+                    # a single task per cycle
+                    current = self.pop_task()
+                    print "### starting " + str(current)
+                    current.run(self)
+                    self.task_done(current)
+                    print "### done with " + str(current)
             else:
                 print "### task queue is empty"
 
@@ -438,10 +711,9 @@ class simulation(fmsobj):
         for key in self.traj:
             if self.traj_map[key] < ntraj:
                 self.traj[key].get_all_qm_data_at_time_from_h5(qm_time)
-        for key in self.centroids:
-            key1, key2 = str.split(key, "_a_")
-            if self.traj_map[key1] < ntraj and self.traj_map[key2] < ntraj:
-                self.centroids[key].get_all_qm_data_at_time_from_h5(qm_time)
+        for key in self.get_active_centroid_keys():
+            self.centroids[key].get_all_qm_data_at_time_from_h5(qm_time)
+        self.pack_qm_data()
 
     def get_qm_data_from_h5_half_step(self):
         """Get the necessary geometries and energies from hdf5 at half ts"""
@@ -452,64 +724,305 @@ class simulation(fmsobj):
             if self.traj_map[key] < ntraj:
                 self.traj[key].\
                     get_all_qm_data_at_time_from_h5_half_step(qm_time)
-        for key in self.centroids:
-            key1, key2 = str.split(key, "_a_")
-            if self.traj_map[key1] < ntraj and self.traj_map[key2] < ntraj:
-                self.centroids[key].\
-                    get_all_qm_data_at_time_from_h5_half_step(qm_time)
+        for key in self.get_active_centroid_keys():
+            self.centroids[key].\
+                get_all_qm_data_at_time_from_h5_half_step(qm_time)
+        self.pack_qm_data_half_step()
+
+    def get_centroid_index(self):
+        """Return a dict with the centroid labels ("keys") and integer
+        arrays with the matrix indices of their two TBFs ("i", "j") and
+        their states ("istate", "jstate").  The arrays are only rebuilt
+        after TBFs or centroids have been added (traj_map may change)"""
+
+        if self._centroid_index is None:
+            keys = self.centroids.keys()
+            index = dict()
+            index["keys"] = keys
+            index["i"] = np.array([self.traj_map[str.split(key, "_a_")[0]] for key in keys],
+                                  dtype=np.int64)
+            index["j"] = np.array([self.traj_map[str.split(key, "_a_")[1]] for key in keys],
+                                  dtype=np.int64)
+            index["istate"] = np.array([self.centroids[key].get_istate() for key in keys],
+                                       dtype=np.int64)
+            index["jstate"] = np.array([self.centroids[key].get_jstate() for key in keys],
+                                       dtype=np.int64)
+            self._centroid_index = index
+        return self._centroid_index
+
+    def get_active_centroid_mask(self):
+        """Return a boolean array marking the centroids (in the order of
+        get_centroid_index) between two TBFs in the quantum propagation"""
+
+        ntraj = self.get_num_traj_qm()
+        index = self.get_centroid_index()
+        return np.logical_and(index["i"] < ntraj, index["j"] < ntraj)
+
+    def get_active_centroid_keys(self):
+        """Return the labels of the centroids between two TBFs in the
+        quantum propagation"""
+
+        keys = self.get_centroid_index()["keys"]
+        return [keys[k] for k in np.flatnonzero(self.get_active_centroid_mask())]
+
+    def get_qm_labels(self):
+        """Return the labels of the TBFs in the quantum propagation,
+        ordered by traj_map"""
+
+        ntraj = self.get_num_traj_qm()
+        labels = [None] * ntraj
+        for key in self.traj:
+            if self.traj_map[key] < ntraj:
+                labels[self.traj_map[key]] = key
+        return tuple(labels)
+
+    def cache_full_step_matrices(self):
+        """Keep the matrices that only depend on full time step data
+        (S, Sinv, T and Sdot) so that the Hamiltonian of the next half
+        step at the same quantum time can reuse them"""
+
+        self._full_step_cache = dict()
+        self._full_step_cache["quantum_time"] = self.get_quantum_time()
+        self._full_step_cache["labels"] = self.get_qm_labels()
+        self._full_step_cache["centroid_keys"] = self.get_centroid_index()["keys"]
+        self._full_step_cache["S"] = self.S
+        self._full_step_cache["Sinv"] = self.Sinv
+        self._full_step_cache["T"] = self.T
+        self._full_step_cache["Sdot"] = self.Sdot
+        self._full_step_cache["state_blocks"] = self._state_blocks
+        self._full_step_cache["S_factors"] = self._S_factors
+
+    def restore_full_step_matrices(self):
+        """Restore S, Sinv, T and Sdot from the cache if they were computed
+        at the current quantum time for the same set of TBFs and
+        centroids.  The set changes (and the cache is invalidated) when a
+        TBF is spawned or enters the quantum propagation.  Returns True if
+        the matrices were restored"""
+
+        cache = self._full_step_cache
+        if cache is None:
+            return False
+        if abs(cache["quantum_time"] - self.get_quantum_time()) > 1.0e-6:
+            return False
+        if cache["labels"] != self.get_qm_labels() \
+                or cache["centroid_keys"] != self.get_centroid_index()["keys"]:
+            self._full_step_cache = None
+            return False
+        print "# reusing S, Sinv, T and Sdot from the previous half step"
+        self.S = cache["S"]
+        self.Sinv = cache["Sinv"]
+        self.T = cache["T"]
+        self.Sdot = cache["Sdot"]
+        self._state_blocks = cache["state_blocks"]
+        self._S_factors = cache["S_factors"]
+        return True
+
+    def pack_qm_data(self):
+        """Pack the full time step data of all TBFs in the quantum
+        propagation into 2D arrays (one row per TBF, ordered by traj_map).
+        The Hamiltonian builders read from these arrays instead of
+        calling the getters of every TBF for every matrix element"""
+
+        labels = self.get_qm_labels()
+        self._qm_data = dict()
+        for name in ["positions_qm", "momenta_qm", "forces_i_qm", "widths",
+                     "masses", "istate", "energies_qm"]:
+            self._qm_data[name] = np.array([getattr(self.traj[key], name) for key in labels])
+        # centroid energies, in the order of get_centroid_index
+        keys = self.get_centroid_index()["keys"]
+        numstates = self.traj[labels[0]].get_numstates()
+        self._qm_data["centroid_energies_qm"] = np.array(
+            [self.centroids[key].energies_qm for key in keys]).reshape(len(keys), numstates)
+
+    def pack_qm_data_half_step(self):
+        """Pack the half time step centroid couplings into a 2D array, in
+        the order of get_centroid_index"""
+
+        keys = self.get_centroid_index()["keys"]
+        numstates = self.traj.itervalues().next().get_numstates()
+        self._qm_data["centroid_timederivcoups_qm"] = np.array(
+            [self.centroids[key].timederivcoups_qm for key in keys]).reshape(len(keys), numstates)
+
+    def build_state_blocks(self):
+        """Group the TBFs in the quantum propagation by electronic state.
+        TBFs on different states do not overlap, so S, T and Sdot are
+        block diagonal in this grouping and only the diagonal blocks
+        need to be built and inverted"""
+
+        istates = self._qm_data["istate"]
+        self._state_blocks = dict()
+        for istate in np.unique(istates):
+            self._state_blocks[istate] = np.flatnonzero(istates == istate)
 
     def build_S(self):
-        """Build the overlap matrix, S"""
+        """Build the overlap matrix, S, one electronic state block at a
+        time"""
 
+        self.build_state_blocks()
+        pos = self._qm_data["positions_qm"]
+        mom = self._qm_data["momenta_qm"]
+        widths = self._qm_data["widths"]
         ntraj = self.get_num_traj_qm()
         self.S = np.zeros((ntraj, ntraj), dtype=np.complex128)
-        for keyi in self.traj:
-            i = self.traj_map[keyi]
-            if i < ntraj:
-                for keyj in self.traj:
-                    j = self.traj_map[keyj]
-                    if j < ntraj:
-                        self.S[i, j] = cg.overlap_nuc_elec(
-                            self.traj[keyi], self.traj[keyj],
-                            positions_i="positions_qm",
-                            positions_j="positions_qm",
-                            momenta_i="momenta_qm",
-                            momenta_j="momenta_qm")
+        for istate in self._state_blocks:
+            idx = self._state_blocks[istate]
+            pairs = self.screen_pairs(idx, idx)
+            if pairs is None:
+                self.S[np.ix_(idx, idx)] = cg.overlap_nuc_matrix(
+                    pos[idx], pos[idx], mom[idx], mom[idx], widths[idx], widths[idx])
+            else:
+                ii, jj = pairs
+                self.S[ii, jj] = cg.overlap_nuc_pairs(pos[ii], pos[jj], mom[ii], mom[jj],
+                                                      widths[ii], widths[jj])
+
+    def build_S_T_Sdot(self):
+        """Build the overlap matrix S, the kinetic energy matrix T and the
+        right-acting time derivative operator Sdot in a single pass over
+        the TBF pairs of each electronic state block.  Equivalent to
+        build_S, build_T and build_Sdot"""
+
+        self.S, self.T, self.Sdot = self.compute_S_T_Sdot()
+
+    def compute_S_T_Sdot(self):
+        """Compute S, T and Sdot one electronic state block at a time from
+        the packed TBF data.  Returns the tuple (S, T, Sdot)"""
+
+        self.build_state_blocks()
+        pos = self._qm_data["positions_qm"]
+        mom = self._qm_data["momenta_qm"]
+        forces = self._qm_data["forces_i_qm"]
+        widths = self._qm_data["widths"]
+        masses = self._qm_data["masses"]
+        ntraj = self.get_num_traj_qm()
+        S = np.zeros((ntraj, ntraj), dtype=np.complex128)
+        T = np.zeros((ntraj, ntraj), dtype=np.complex128)
+        Sdot = np.zeros((ntraj, ntraj), dtype=np.complex128)
+        for istate in self._state_blocks:
+            idx = self._state_blocks[istate]
+            pairs = self.screen_pairs(idx, idx)
+            if pairs is None:
+                block = np.ix_(idx, idx)
+                S[block], T[block], Sdot[block] = \
+                    cg.overlap_kinetic_Sdot_nuc_matrix(pos[idx], pos[idx], mom[idx],
+                                                       mom[idx], forces[idx], widths[idx],
+                                                       widths[idx], masses[idx])
+            else:
+                ii, jj = pairs
+                S[ii, jj], T[ii, jj], Sdot[ii, jj] = \
+                    cg.overlap_kinetic_Sdot_nuc_pairs(pos[ii], pos[jj], mom[ii],
+                                                      mom[jj], forces[jj], widths[ii],
+                                                      widths[jj], masses[ii])
+        return S, T, Sdot
+
+    def screen_pairs(self, idxi, idxj):
+        """Bound the overlaps of the TBFs idxi with the TBFs idxj by their
+        phase-space distance and return the matrix indices (ii, jj) of the
+        pairs that are not negligible.  Returns None if screening is off
+        or no pair can be skipped, in which case all pairs are computed"""
+
+        if self.pair_screen_thresh <= 0.0:
+            return None
+        pos = self._qm_data["positions_qm"]
+        mom = self._qm_data["momenta_qm"]
+        widths = self._qm_data["widths"]
+        dist = cg.phase_space_distance_matrix(pos[idxi], pos[idxj], mom[idxi], mom[idxj],
+                                              widths[idxi], widths[idxj])
+        keep = dist < -np.log(self.pair_screen_thresh)
+        if np.all(keep):
+            return None
+        ki, kj = np.nonzero(keep)
+        return np.asarray(idxi)[ki], np.asarray(idxj)[kj]
 
     def build_Sdot(self):
         """Build the right-acting time derivative operator"""
 
-        ntraj = self.get_num_traj_qm()
-        self.Sdot = np.zeros((ntraj, ntraj), dtype=np.complex128)
-        for keyi in self.traj:
-            i = self.traj_map[keyi]
-            if i < ntraj:
-                for keyj in self.traj:
-                    j = self.traj_map[keyj]
-                    if j < ntraj:
-                        self.Sdot[i, j] = cg.Sdot_nuc_elec(
-                            self.traj[keyi],
-                            self.traj[keyj],
-                            positions_i="positions_qm",
-                            positions_j="positions_qm",
-                            momenta_i="momenta_qm",
-                            momenta_j="momenta_qm",
-                            forces_j="forces_i_qm")
+        self.Sdot = self.compute_S_T_Sdot()[2]
+
+    def get_S_blocks(self):
+        """Return a dict mapping keys to the matrix indices of the
+        diagonal blocks of S (a single block if S is not block
+        diagonal)"""
+
+        if self._state_blocks is None:
+            return {"all": np.arange(self.get_num_traj_qm())}
+        return self._state_blocks
 
     def invert_S(self):
-        """Compute Sinv from S"""
-        self.Sinv = np.linalg.inv(self.S)
+        """Invert or factorize S, according to S_factorization, one
+        diagonal block at a time (a single block if S is not block
+        diagonal).  Heff is obtained from the blocks (see build_Heff) and
+        Sinv is only assembled when needed (see get_Sinv)"""
+
+        blocks = self.get_S_blocks()
+        self._S_factors = dict()
+        self.Sinv = None
+        for key in blocks:
+            block = np.ix_(blocks[key], blocks[key])
+            if self.S_factorization == "inv":
+                self._S_factors[key] = ("inv", np.linalg.inv(self.S[block]))
+            else:
+                self._S_factors[key] = self.factorize_S_block(self.S[block], key)
+
+    def factorize_S_block(self, Sblock, key):
+        """Factorize a diagonal block of S according to S_factorization
+        and report its condition number (for cholesky, a lower bound
+        obtained from the diagonal of the factor)"""
 
-    def build_H(self):
+        if self.S_factorization == "cholesky":
+            if spl is not None:
+                factor = spl.cho_factor(Sblock, lower=True)
+                L = factor[0]
+            else:
+                L = np.linalg.cholesky(Sblock)
+                factor = (L, True)
+            # cheap lower bound from the diagonal of the Cholesky factor
+            diag = np.absolute(np.diagonal(L))
+            cond = (np.max(diag) / np.min(diag)) ** 2
+            print "# lower bound of the condition number of S block", key, ":", cond
+            return ("cholesky", factor)
+
+        # canonical orthogonalization: directions in which S is (nearly)
+        # singular are projected out
+        evals, evecs = np.linalg.eigh(Sblock)
+        print "# condition number of S block", key, ":", evals[-1] / evals[0]
+        keep = evals > self.S_canonical_thresh
+        if not np.all(keep):
+            ndrop = int(np.sum(np.logical_not(keep)))
+            self.S_canonical_ndrop += ndrop
+            print "# canonical orthogonalization drops", ndrop,\
+                "near linearly dependent direction(s) of S block", key
+        return ("canonical", (evecs[:, keep], evals[keep]))
+
+    def solve_S_block(self, factor, rhs):
+        """Apply the inverse of a diagonal block of S, as factorized by
+        invert_S, to rhs"""
+
+        kind, data = factor
+        if kind == "inv":
+            return np.matmul(data, rhs)
+        if kind == "cholesky":
+            if spl is not None:
+                return spl.cho_solve(data, rhs)
+            # without scipy: general solves with the triangular factors
+            L = data[0]
+            tmp = np.linalg.solve(L, rhs)
+            return np.linalg.solve(L.conj().T, tmp)
+        evecs, evals = data
+        tmp = np.matmul(evecs.conj().T, rhs)
+        return np.matmul(evecs, (tmp.T / evals).T)
+
+    def build_H(self, zbuild_T=True):
         """Build the Hamiltonian matrix, H
-        This routine assumes that S is already built"""
+        This routine assumes that S is already built (and T as well
+        if zbuild_T is False)"""
 
         print "# building potential energy matrix"
         self.build_V()
         print "# building NAC matrix"
         self.build_tau()
-        print "# building kinetic energy matrix"
-        self.build_T()
+        if zbuild_T:
+            print "# building kinetic energy matrix"
+            self.build_T()
         ntraj = self.get_num_traj_qm()
         shift = self.get_qm_energy_shift() * np.identity(ntraj)
         print "# summing Hamiltonian"
@@ -521,132 +1034,153 @@ class simulation(fmsobj):
 
         ntraj = self.get_num_traj_qm()
         self.V = np.zeros((ntraj, ntraj), dtype=np.complex128)
-        for key in self.traj:
-            i = self.traj_map[key]
-            istate = self.traj[key].get_istate()
-            if i < ntraj:
-                self.V[i, i] = self.traj[key].get_energies_qm()[istate]
-        for key in self.centroids:
-            keyi, keyj = str.split(key, "_a_")
-            i = self.traj_map[keyi]
-            j = self.traj_map[keyj]
-            if i < ntraj and j < ntraj:
-                istate = self.centroids[key].get_istate()
-                jstate = self.centroids[key].get_jstate()
-                if istate == jstate:
-                    E = self.centroids[key].get_energies_qm()[istate]
-                    self.V[i, j] = self.S[i, j] * E
-                    self.V[j, i] = self.S[j, i] * E
+        diag = np.arange(ntraj)
+        self.V[diag, diag] = self._qm_data["energies_qm"][diag, self._qm_data["istate"]]
+        index = self.get_centroid_index()
+        mask = np.logical_and(self.get_active_centroid_mask(),
+                              index["istate"] == index["jstate"])
+        ii = index["i"][mask]
+        jj = index["j"][mask]
+        E = self._qm_data["centroid_energies_qm"][mask, index["istate"][mask]]
+        self.V[ii, jj] = self.S[ii, jj] * E
+        self.V[jj, ii] = self.S[jj, ii] * E
 
     def build_tau(self):
         """Build the nonadiabatic coupling matrix, tau
-        This routine assumes that S is already built"""
+        Only the blocks that couple different electronic states are
+        nonzero.  The nuclear overlaps of the coupled pairs are computed
+        here because S only holds the same-state blocks"""
 
         c1i = (complex(0.0, 1.0))
         cm1i = (complex(0.0, -1.0))
         ntraj = self.get_num_traj_qm()
         self.tau = np.zeros((ntraj, ntraj), dtype=np.complex128)
-        for key in self.centroids:
-            keyi, keyj = str.split(key, "_a_")
-            i = self.traj_map[keyi]
-            j = self.traj_map[keyj]
-            if i < ntraj and j < ntraj:
-                istate = self.centroids[key].get_istate()
-                jstate = self.centroids[key].get_jstate()
-                if istate != jstate:
-                    Sij = cg.overlap_nuc(self.traj[keyi],
-                                         self.traj[keyj],
-                                         positions_i="positions_qm",
-                                         positions_j="positions_qm",
-                                         momenta_i="momenta_qm",
-                                         momenta_j="momenta_qm")
-                    tdc = self.centroids[key].get_timederivcoups_qm()[jstate]
-                    self.tau[i, j] = Sij * cm1i * tdc
-                    self.tau[j, i] = Sij.conjugate() * c1i * tdc
+        index = self.get_centroid_index()
+        mask = np.logical_and(self.get_active_centroid_mask(),
+                              index["istate"] != index["jstate"])
+        if not np.any(mask):
+            return
+        ii = index["i"][mask]
+        jj = index["j"][mask]
+        tdc = self._qm_data["centroid_timederivcoups_qm"][mask, index["jstate"][mask]]
+        pos = self._qm_data["positions_qm"]
+        mom = self._qm_data["momenta_qm"]
+        widths = self._qm_data["widths"]
+        if self.pair_screen_thresh > 0.0:
+            # same phase-space distance bound as screen_pairs
+            dist = cg.phase_space_distance_pairs(pos[ii], pos[jj], mom[ii], mom[jj],
+                                                 widths[ii], widths[jj])
+            keep = dist < -np.log(self.pair_screen_thresh)
+            ii = ii[keep]
+            jj = jj[keep]
+            tdc = tdc[keep]
+        Sij = cg.overlap_nuc_pairs(pos[ii], pos[jj], mom[ii], mom[jj],
+                                   widths[ii], widths[jj])
+        self.tau[ii, jj] = Sij * cm1i * tdc
+        self.tau[jj, ii] = Sij.conjugate() * c1i * tdc
 
     def build_T(self):
         """build the kinetic energy matrix, T"""
 
-        ntraj = self.get_num_traj_qm()
-        self.T = np.zeros((ntraj, ntraj), dtype=np.complex128)
-        for keyi in self.traj:
-            i = self.traj_map[keyi]
-            if i < ntraj:
-                for keyj in self.traj:
-                    j = self.traj_map[keyj]
-                    if j < ntraj:
-                        self.T[i, j] = cg.kinetic_nuc_elec(
-                            self.traj[keyi],
-                            self.traj[keyj],
-                            positions_i="positions_qm",
-                            positions_j="positions_qm",
-                            momenta_i="momenta_qm",
-                            momenta_j="momenta_qm")
+        self.T = self.compute_S_T_Sdot()[1]
 
     def build_Heff(self):
-        """built Heff form H, Sinv, and Sdot"""
+        """built Heff form H, Sinv (or the factorization of S), and Sdot"""
 
         print "# building effective Hamiltonian"
         c1i = (complex(0.0, 1.0))
-        self.Heff = np.matmul(self.Sinv, (self.H - c1i * self.Sdot))
+        # S is block diagonal, so each block of rows of Heff only
+        # needs the corresponding diagonal block of S
+        HmiSdot = self.H - c1i * self.Sdot
+        self.Heff = np.zeros_like(HmiSdot)
+        blocks = self.get_S_blocks()
+        for key in blocks:
+            idx = blocks[key]
+            self.Heff[idx, :] = self.solve_S_block(self._S_factors[key], HmiSdot[idx, :])
 
     def pop_task(self):
         """pop the task from the top of the queue"""
 
-        return self.queue.pop(0)
+        t = heapq.heappop(self._task_heap)[-1]
+        self._task_ids.discard(t.get_id())
+        return t
+
+    def pop_ready_tasks(self):
+        """pop up to num_workers tasks from the top of the queue, at most
+        one per trajectory or centroid (tasks on the same TBF, e.g. forward
+        and backward propagation, are left in the queue).  All queued
+        tasks can run; the order is the one of task_priority"""
+
+        tasks = []
+        skipped = []
+        targets = set()
+        while len(self._task_heap) > 0 and len(tasks) < self.get_num_workers():
+            entry = heapq.heappop(self._task_heap)
+            t = entry[-1]
+            if (t.target, t.key) in targets:
+                skipped.append(entry)
+            else:
+                targets.add((t.target, t.key))
+                self._task_ids.discard(t.get_id())
+                tasks.append(t)
+        for entry in skipped:
+            heapq.heappush(self._task_heap, entry)
+        return tasks
+
+    def get_num_parallel_tasks(self):
+        """Get the number of queued tasks that can run at the same time (one
+        per trajectory or centroid)"""
+
+        return len(set((entry[-1].target, entry[-1].key) for entry in self._task_heap))
+
+    def task_done(self, t):
+        """update the queue after the task t has run: trajectories are
+        requeued for their next step, centroids are queued again by
+        update_centroids once they can be computed"""
+
+        if t.target == "traj":
+            self.add_traj_tasks(t.key)
+
+    def run_tasks_parallel(self, tasks):
+        """run independent tasks concurrently in a pool of num_workers
+        threads.  The electronic structure calls release the interpreter
+        while they wait, and the hdf5 output is queued for the writer
+        thread of h5writer.
+        The results are collected in queue order, so the first task to
+        fail (in queue order) raises its exception here"""
+
+        if self._pool is None:
+            self._pool = ThreadPool(self.get_num_workers())
+        results = []
+        for current in tasks:
+            print "### starting " + str(current)
+            results.append(self._pool.apply_async(current.run, (self,)))
+        for current, result in zip(tasks, results):
+            result.get()
+            self.task_done(current)
+            print "### done with " + str(current)
+
+    def close_pool(self):
+        """stop the worker threads of run_tasks_parallel"""
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
 
     def update_queue(self):
-        """build a list of all tasks that need to be completed"""
-
-        while self.queue[0] != "END":
-            self.queue.pop(0)
-        tasktimes = [1e10]
+        """bring the task queue up to date.  The queue is maintained
+        incrementally (see add_traj, task_done and update_centroids), so
+        only the first call, at the start or after a restart, has to go
+        through all trajectories"""
 
-        # forward propagation tasks
-        for key in self.traj:
-            if (self.traj[key].get_maxtime() + 1.0e-6) > self.traj[key].get_time():
-                task_tmp = "self.traj[\""\
-                    + key + "\"].propagate_step()"
-                tasktime_tmp = self.traj[key].get_time()
-                self.insert_task(task_tmp, tasktime_tmp, tasktimes)
+        if not self._task_heap_ready:
+            for key in self.traj:
+                self.add_traj_tasks(key)
+            self._task_heap_ready = True
 
-        # backward propagation tasks
-        for key in self.traj:
-            if (self.traj[key].get_mintime()+1.0e-6) < self.traj[key].get_backprop_time():
-                task_tmp = "self.traj[\"" + key\
-                    + "\"].propagate_step(zbackprop=True)"
-                tasktime_tmp = self.traj[key].get_backprop_time()
-                self.insert_task(task_tmp, tasktime_tmp, tasktimes)
-
-        # centroid tasks (forward propagation)
-        for key in self.centroids:
-            if self.centroids[key].get_z_compute_me():
-                task_tmp = "self.centroids[\"" + key\
-                    + "\"].compute_centroid()"
-                tasktime_tmp = self.centroids[key].get_time()
-                self.insert_task(task_tmp,tasktime_tmp, tasktimes)
-
-        # centroid tasks (backward propagation)
-        for key in self.centroids:
-            if self.centroids[key].get_z_compute_me_backprop():
-                task_tmp = "self.centroids[\"" + key +\
-                    "\"].compute_centroid(zbackprop=True)"
-                tasktime_tmp = self.centroids[key].get_backprop_time()
-                self.insert_task(task_tmp, tasktime_tmp, tasktimes)
-
-        print "##", (len(self.queue)-1), "task(s) in queue:"
-        for i in range(len(self.queue)-1):
-            print self.queue[i] + ", time = " + str(tasktimes[i])
-        print "END"
-
-    def insert_task(self, task, tt, tasktimes):
-        """Add a task to the queue"""
-
-        for i in range(len(tasktimes)):
-            if tt < tasktimes[i]:
-                self.queue.insert(i, task)
-                tasktimes.insert(i, tt)
-                return
+        print "##", self.get_numtasks(), "task(s) in queue,", self.get_num_parallel_tasks(), \
+            "can run in parallel"
 
     def update_centroids(self):
         """Compute the centroid positions and moment and check which centroids
@@ -683,13 +1217,13 @@ class simulation(fmsobj):
                             pos2 = self.traj[key2].get_data_at_time_from_h5(backprop_time, "positions")
                             mom2 = self.traj[key2].get_data_at_time_from_h5(backprop_time, "momenta")
 #                             pos2, mom2 = self.traj[key2].get_q_and_p_at_time_from_h5(backprop_time)
-                            absSij = abs(cg.overlap_nuc(self.traj[key1],
-                                                        self.traj[key2],
-                                                        positions_i=pos1,
-                                                        positions_j=pos2,
-                                                        momenta_i=mom1,
-                                                        momenta_j=mom2))
-#                             print "absSij", absSij
+                            logabsSij = cg.log_abs_overlap_nuc(self.traj[key1],
+                                                               self.traj[key2],
+                                                               positions_i=pos1,
+                                                               positions_j=pos2,
+                                                               momenta_i=mom1,
+                                                               momenta_j=mom2)
+#                             print "logabsSij", logabsSij
                             # this definition of mom is only right if all basis functions have same
                             # width!!!!  I don't think the momentum is every used but still we 
                             # should fix this soon.
@@ -699,8 +1233,10 @@ class simulation(fmsobj):
                             mom_cent = 0.5 * (mom1 + mom2)
                             self.centroids[key].set_backprop_positions(pos_cent)
                             self.centroids[key].set_backprop_momenta(mom_cent)
-                            if absSij > 0.001:
+                            if logabsSij > np.log(0.001):
                                 self.centroids[key].set_z_compute_me_backprop(True)
+                                self.add_task(task("centroids", key, True,
+                                                   self.centroids[key].get_backprop_time()))
                             else:
                                 self.centroids[key].set_backprop_time(backprop_time)
                                 dt = self.centroids[key].get_timestep()
@@ -728,13 +1264,13 @@ class simulation(fmsobj):
                         mom2 = self.traj[key2].get_data_at_time_from_h5(time, "momenta")
                         #pos1, mom1 = self.traj[key1].get_q_and_p_at_time_from_h5(time)
                         #pos2, mom2 = self.traj[key2].get_q_and_p_at_time_from_h5(time)
-                        absSij = abs(cg.overlap_nuc(self.traj[key1],
-                                                    self.traj[key2],
-                                                    positions_i=pos1,
-                                                    positions_j=pos2,
-                                                    momenta_i=mom1,
-                                                    momenta_j=mom2))
-                        #print "absSij", absSij
+                        logabsSij = cg.log_abs_overlap_nuc(self.traj[key1],
+                                                           self.traj[key2],
+                                                           positions_i=pos1,
+                                                           positions_j=pos2,
+                                                           momenta_i=mom1,
+                                                           momenta_j=mom2)
+                        #print "logabsSij", logabsSij
                         # this definion of mom is only correct if all basis functions have same
                         # width!!!!  I don't think that the centroid momentum is ever used, but
                         # we should still fix this soon
@@ -744,8 +1280,10 @@ class simulation(fmsobj):
                         mom_cent = 0.5 * ( mom1 + mom2 )
                         self.centroids[key].set_positions(pos_cent)
                         self.centroids[key].set_momenta(mom_cent)
-                        if absSij > 0.001:
+                        if logabsSij > np.log(0.001):
                             self.centroids[key].set_z_compute_me(True)
+                            self.add_task(task("centroids", key, False,
+                                               self.centroids[key].get_time()))
                         else:
                             self.centroids[key].set_time(time)
                             dt = self.centroids[key].get_timestep()
@@ -838,6 +1376,7 @@ class simulation(fmsobj):
 
                 # add the centroid
                 self.centroids[centkey] = newcent
+                self._centroid_index = None
                 print "# adding centroid ", centkey
 
             # finally, add the spawned trajectory
@@ -848,15 +1387,26 @@ class simulation(fmsobj):
         with any existing trajectory"""
 
         z_add_traj = True
-        for key2 in self.traj:
-            # compute the overlap
-            overlap = cg.overlap_nuc_elec(newtraj,
-                                          self.traj[key2],
-                                          positions_j="positions_tmdt",
-                                          momenta_j="momenta_tmdt")
-
+        keys = self.traj.keys()
+        pos = np.asarray([self.traj[key2].get_positions_tmdt() for key2 in keys])
+        mom = np.asarray([self.traj[key2].get_momenta_tmdt() for key2 in keys])
+        widths = np.asarray([self.traj[key2].get_widths() for key2 in keys])
+        istates = np.asarray([self.traj[key2].get_istate() for key2 in keys])
+        # compute the log-magnitudes of the overlaps with all existing
+        # trajectories at once, so that nothing underflows in many
+        # dimensions
+        log_overlaps = cg.log_abs_overlap_nuc_elec_matrix(newtraj.get_positions()[np.newaxis, :],
+                                                          pos,
+                                                          newtraj.get_momenta()[np.newaxis, :],
+                                                          mom,
+                                                          newtraj.get_widths()[np.newaxis, :],
+                                                          widths,
+                                                          np.asarray([newtraj.get_istate()]),
+                                                          istates)[0, :]
+
+        for log_overlap in log_overlaps:
             # if the overlap is too high, don't spawn!
-            if np.absolute(overlap) > self.olapmax:
+            if log_overlap > np.log(self.olapmax):
                 z_add_traj = False
                 print "# aborting spawn due to large overlap with existing trajectory"
 
@@ -867,15 +1417,28 @@ class simulation(fmsobj):
         into working.hdf5"""
 
         self.read_from_file(json_file)
+        # the handles of a working.hdf5 opened before are not valid anymore
+        h5writer.close()
         shutil.copy2(h5_file, "working.hdf5")
 
     def restart_output(self):
         """output json restart file
         The json file is meant to represent the *current* state of the
         simulation.  There is a separate hdf5 file that stores the history of
-        the simulation.  Both are needed for restart."""
+        the simulation.  Both are needed for restart.
+        The state is converted to json now, and the files are written by the
+        write-behind queue of the hdf5 output (see write_restart_files),
+        after the rows queued before, so that the loop does not wait for
+        the output"""
 
         print "## creating new sim.json"
+        h5writer.submit(functools.partial(self.write_restart_files,
+                                          self.to_json()))
+
+    def write_restart_files(self, json_text):
+        """Write the json restart file sim.json with the contents json_text
+        and copy working.hdf5 to sim.hdf5, keeping the previous files"""
+
         # we keep copies of the last 3 json files just to be safe
         extensions = [2, 1, 0]
         for i in extensions:
@@ -896,7 +1459,8 @@ class simulation(fmsobj):
                         shutil.move(filename, filename2)
 
         # now we write the current json file
-        self.write_to_file("sim.json")
+        with open("sim.json", "w") as outputfile:
+            outputfile.write(json_text)
         print "## synchronizing sim.hdf5"
         extensions = [2, 1, 0]
         for i in extensions:
@@ -915,6 +1479,8 @@ class simulation(fmsobj):
                         shutil.copy2(filename, filename2)
                     else:
                         shutil.move(filename, filename2)
+        # working.hdf5 stays open, its changes are written before the copy
+        h5cache.flush()
         shutil.copy2("working.hdf5", "sim.hdf5")
         print "## hdf5 and json output are synchronized"
 
@@ -922,7 +1488,6 @@ class simulation(fmsobj):
         """Outputs info into h5 file"""
 
         self.init_h5_datasets()
-        filename = "working.hdf5"
 #         extensions = [3,2,1,0]
 #         for i in extensions :
 #             if i==0:
@@ -940,44 +1505,61 @@ class simulation(fmsobj):
 #                         shutil.copy2(filename, filename2)
 #                     else:
 #                         shutil.move(filename, filename2)
-        h5f = h5py.File(filename, "a")
+        values = dict()
+        for key in self.h5_datasets:
+            getcom = "self.get_" + key + "()"
+#             print getcom
+            tmp = eval(getcom)
+            if type(tmp).__module__ == np.__name__:
+                tmp = np.ndarray.flatten(tmp)
+            values[key] = tmp
+        (labels, istates) = self.get_h5_map()
+        # the row is written by the write-behind queue
+        h5writer.submit(functools.partial(self.write_h5_sim, self.h5_datasets,
+                                          values, labels, istates))
+
+    def write_h5_sim(self, datasets, values, labels, istates):
+        """Appends the values of the datasets to the h5 simulation group.
+        labels and istates are the mapping of trajectory number to their
+        labels and states when the values were computed"""
+
+        cache = h5cache.get_cache()
         groupname = "sim"
-        if groupname not in h5f.keys():
+        grp = cache.get_group(groupname)
+        if grp is None:
             # creating sim group in hdf5 output file
-            self.create_h5_sim(h5f, groupname)
-            grp = h5f.get(groupname)
-            self.create_new_h5_map(grp)
-        else:
-            grp = h5f.get(groupname)
+            self.create_h5_sim(cache, groupname, datasets)
+            grp = cache.get_group(groupname)
+            self.create_new_h5_map(grp, labels, istates)
         znewmap = False
-        for key in self.h5_datasets:
-            n = self.h5_datasets[key]
-            dset = grp.get(key)
-            l = dset.len()
+        nrows = h5output.get_length(cache.get_dataset(groupname, "quantum_time"))
+        for key in datasets:
+            n = datasets[key]
+            dset = cache.get_dataset(groupname, key)
+            if dset is None:
+                # a dataset missing in the file of an older version starts
+                # with zero rows up to the current step
+                dset = h5output.create_dataset(grp, key, n, dtype=self.h5_types[key],
+                                               maxshape=(None, None))
+                h5output.set_length(dset, nrows)
+            l = h5output.get_length(dset)
             if l > 0:
-                lwidth = dset.size / l
+                lwidth = dset.shape[1]
                 if n > lwidth:
-                    dset.resize(n, axis=1)
+                    # recreated, the chunks span the width of the rows
+                    dset = cache.widen_dataset(groupname, key, n)
                     if not znewmap:
-                        self.create_new_h5_map(grp)
+                        self.create_new_h5_map(grp, labels, istates)
                         znewmap = True
-            dset.resize(l+1, axis=0)
-            ipos = l
-            getcom = "self.get_" + key + "()"
-#             print getcom
-            tmp = eval(getcom)
+            ipos = h5output.append_row(dset)
+            tmp = values[key]
             if type(tmp).__module__ == np.__name__:
-                tmp = np.ndarray.flatten(tmp)
                 dset[ipos, 0:n] = tmp[0:n]
             else:
                 dset[ipos, 0] = tmp
-        h5f.flush()
-        h5f.close()
 
-    def create_new_h5_map(self, grp):
-        """Creates mapping of trajectory number to their labels
-        This is important because traj dictionaries are not ordered
-        with quantum aplitudes"""
+    def get_h5_map(self):
+        """Mapping of trajectory number to their labels and states"""
 
         ntraj = self.get_num_traj_qm()
         labels = np.empty(ntraj, dtype="S512")
@@ -986,18 +1568,25 @@ class simulation(fmsobj):
             if self.traj_map[key] < ntraj:
                 labels[self.traj_map[key]] = key
                 istates[self.traj_map[key]] = self.traj[key].get_istate()
+        return labels, istates
+
+    def create_new_h5_map(self, grp, labels, istates):
+        """Creates mapping of trajectory number to their labels
+        This is important because traj dictionaries are not ordered
+        with quantum aplitudes"""
+
         grp.attrs["labels"] = labels
         grp.attrs["istates"] = istates
 
-    def create_h5_sim(self, h5f, groupname):
+    def create_h5_sim(self, cache, groupname, datasets):
         """Create h5 simulation datasets"""
 
-        trajgrp = h5f.create_group(groupname)
-        for key in self.h5_datasets:
-            n = self.h5_datasets[key]
-            dset = trajgrp.create_dataset(key, (0, n),
-                                          maxshape=(None, None),
-                                          dtype=self.h5_types[key])
+        trajgrp = cache.create_group(groupname)
+        for key in datasets:
+            n = datasets[key]
+            dset = h5output.create_dataset(trajgrp, key, n,
+                                           dtype=self.h5_types[key],
+                                           maxshape=(None, None))
 
     def init_h5_datasets(self):
         """Initialize simulation h5 file"""
@@ -1022,3 +1611,7 @@ class simulation(fmsobj):
         self.h5_types["Sdot"] = "complex128"
         self.h5_types["Sinv"] = "complex128"
         self.h5_types["num_traj_qm"] = "int32"
+        # only the pade integrator records the norm drift
+        if self.qm_norm_drift is not None:
+            self.h5_datasets["qm_norm_drift"] = 1
+            self.h5_types["qm_norm_drift"] = "float64"
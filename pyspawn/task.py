@@ -0,0 +1,40 @@
+class task(object):
+    """A task for the simulation scheduler: one forward or backward step of
+    a trajectory (propagate_step) or of a centroid (compute_centroid).
+    target is the name of the simulation dictionary holding the TBF
+    ("traj" or "centroids"), key its label and time the simulation time
+    of the TBF when the task was queued, which orders the queue"""
+
+    def __init__(self, target, key, zbackprop, time):
+        self.target = target
+        self.key = key
+        self.zbackprop = zbackprop
+        self.time = time
+
+    def get_kind(self):
+        if self.target == "traj":
+            return "propagate_step"
+        else:
+            return "compute_centroid"
+
+    def get_id(self):
+        """Identifies the task independently of its time: a TBF has at most
+        one queued task per direction"""
+
+        return (self.target, self.key, self.zbackprop)
+
+    def run(self, sim):
+        """Run the task on the TBF it refers to in the simulation sim"""
+
+        tbf = getattr(sim, self.target)[self.key]
+        if self.target == "traj":
+            tbf.propagate_step(zbackprop=self.zbackprop)
+        else:
+            tbf.compute_centroid(zbackprop=self.zbackprop)
+
+    def __str__(self):
+        if self.zbackprop:
+            args = "zbackprop=True"
+        else:
+            args = ""
+        return "self." + self.target + "[\"" + self.key + "\"]." + self.get_kind() + "(" + args + ")"
@@ -0,0 +1,265 @@
+import threading
+import time
+import Queue
+import socket
+from multiprocessing.pool import ThreadPool
+try:
+    from tcpb.tcpb import TCProtobufClient
+except ImportError:
+    TCProtobufClient = None
+try:
+    from tcpb.exceptions import ServerError
+    _connection_errors = (socket.error, ServerError)
+except ImportError:
+    _connection_errors = (socket.error,)
+
+######################################################
+# dispatcher of electronic structure jobs to a pool of TeraChem servers
+######################################################
+
+# A job is a callable taking a connected client (a TCProtobufClient or any
+# object with the same interface) and returning the results the potential
+# needs.  All the requests of one job are sent to the same server, since
+# later requests read files (CI vectors, orbitals) written by earlier ones.
+
+
+class tc_client_pool(object):
+    """Connected clients, one per server (a (host, port) tuple), kept open
+    across jobs.  A client idle for more than idle_timeout seconds is
+    checked with is_available before its next job and reconnected if the
+    check fails; a job that fails with a connection error is run once more
+    on a new connection.  The jobs of a server are run one at a time.
+    client_class is the class of the clients (TCProtobufClient by
+    default)"""
+
+    def __init__(self, client_class=None, idle_timeout=60.0):
+        if client_class is None:
+            client_class = TCProtobufClient
+        if client_class is None:
+            raise ImportError("tcpb is not available, no TeraChem client class")
+        self.client_class = client_class
+        self.idle_timeout = idle_timeout
+        # number of connections made to each server
+        self.nconnect = dict()
+
+        self._clients = dict()
+        self._options = dict()
+        # time the last job of each client ended
+        self._last_used = dict()
+        self._locks = dict()
+        self._lock = threading.Lock()
+
+    def get_server_lock(self, server):
+        with self._lock:
+            if server not in self._locks:
+                self._locks[server] = threading.Lock()
+                self.nconnect[server] = 0
+            return self._locks[server]
+
+    def connect(self, server):
+        """Open a new connection to server"""
+
+        self.disconnect(server)
+        (host, port) = server
+        TC = self.client_class(host=host, port=port)
+        TC.connect()
+        with self._lock:
+            self._clients[server] = TC
+            self.nconnect[server] += 1
+        return TC
+
+    def disconnect(self, server):
+        with self._lock:
+            TC = self._clients.pop(server, None)
+            self._options.pop(server, None)
+        if TC is not None:
+            try:
+                TC.disconnect()
+            except _connection_errors:
+                pass
+
+    def is_healthy(self, TC):
+        """Health check of a client: the server answers a status request
+        (whether it is available or still busy)"""
+
+        try:
+            TC.is_available()
+        except _connection_errors:
+            return False
+        return True
+
+    def get_client(self, server, options=None):
+        """Connected and available client for server.  The default job
+        options of the client are updated to options, if given, when they
+        differ from the ones sent before"""
+
+        with self._lock:
+            TC = self._clients.get(server)
+            last_used = self._last_used.get(server, 0.0)
+        if TC is None:
+            TC = self.connect(server)
+        elif time.time() - last_used > self.idle_timeout and not self.is_healthy(TC):
+            TC = self.connect(server)
+        if options is not None and self._options.get(server) != options:
+            TC.update_options(**options)
+            self._options[server] = options.copy()
+        return TC
+
+    def run_job(self, server, job, options=None):
+        """Run job on server, reconnecting once if the connection fails"""
+
+        with self.get_server_lock(server):
+            try:
+                return self.run_on_client(server, job, options)
+            except _connection_errors:
+                self.disconnect(server)
+            return self.run_on_client(server, job, options)
+
+    def run_on_client(self, server, job, options=None):
+        """Run job on the client of server"""
+
+        TC = self.get_client(server, options)
+        try:
+            return job(TC)
+        finally:
+            with self._lock:
+                self._last_used[server] = time.time()
+
+    def get_nconnect(self):
+        with self._lock:
+            return self.nconnect.copy()
+
+    def close(self):
+        with self._lock:
+            servers = self._clients.keys()
+        for server in servers:
+            self.disconnect(server)
+
+
+class tc_dispatcher(object):
+    """Pool of TeraChem server endpoints.  Jobs are submitted with submit,
+    which returns immediately with a future (an AsyncResult, whose get
+    method waits for the results of the job).  Each job runs on the server
+    that has been idle for the longest time, and waits for one to become
+    idle if all servers are busy, so the load is balanced over the servers
+    regardless of which TBF the job comes from.
+    servers is a list of (host, port) tuples, client_class the class of
+    the clients (TCProtobufClient by default)"""
+
+    def __init__(self, servers, client_class=None):
+        self.servers = [(host, int(port)) for (host, port) in servers]
+        self.clients = tc_client_pool(client_class)
+        # number of jobs run on each server
+        self.njobs = dict()
+
+        self._idle = Queue.Queue()
+        for server in self.servers:
+            self._idle.put(server)
+            self.njobs[server] = 0
+        self._lock = threading.Lock()
+        # one worker thread per server, since a server runs one job at a time
+        self._pool = ThreadPool(len(self.servers))
+
+    def submit(self, job, options=None):
+        """Submit job to the next idle server, returns a future"""
+
+        return self._pool.apply_async(self.run_job, (job, options))
+
+    def run_job(self, job, options=None):
+        """Run job on the server idle for the longest time, waiting for one
+        if all servers are busy"""
+
+        server = self._idle.get()
+        try:
+            with self._lock:
+                self.njobs[server] += 1
+            return self.clients.run_job(server, job, options)
+        finally:
+            self._idle.put(server)
+
+    def get_num_servers(self):
+        return len(self.servers)
+
+    def get_njobs(self):
+        with self._lock:
+            return self.njobs.copy()
+
+    def close(self):
+        """Wait for the submitted jobs and stop the worker threads"""
+
+        self._pool.close()
+        self._pool.join()
+        self.clients.close()
+
+
+# the dispatcher of the process, None if the servers are not set
+_dispatcher = None
+# the clients of the process used without dispatcher
+_client_pool = None
+_pool_lock = threading.Lock()
+
+
+def set_servers(servers, client_class=None):
+    """Set the TeraChem servers used by all TBFs of the process.  servers is
+    a list of (host, port) tuples.  An empty list resets the dispatcher,
+    and every TBF falls back to the server on its own tc_port"""
+
+    global _dispatcher
+    if _dispatcher is not None:
+        _dispatcher.close()
+    if len(servers) > 0:
+        _dispatcher = tc_dispatcher(servers, client_class)
+    else:
+        _dispatcher = None
+
+
+def get_dispatcher():
+    return _dispatcher
+
+
+def get_client_pool():
+    """The clients of the process used without dispatcher"""
+
+    global _client_pool
+    with _pool_lock:
+        if _client_pool is None:
+            _client_pool = tc_client_pool()
+        return _client_pool
+
+
+def submit(job, port, options=None):
+    """Submit job to the dispatcher of the process.  Without dispatcher, the
+    job runs right away on the server at localhost:port and the returned
+    future is already done.  options are the default job options of the
+    client"""
+
+    if _dispatcher is not None:
+        return _dispatcher.submit(job, options)
+
+    results = get_client_pool().run_job(('localhost', port), job, options)
+    return _done_future(results)
+
+
+def run_job(job, port, options=None):
+    """Run job through the dispatcher of the process and wait for the
+    results"""
+
+    return submit(job, port, options).get()
+
+
+class _done_future(object):
+    """A future holding results that are already available"""
+
+    def __init__(self, results):
+        self.results = results
+
+    def ready(self):
+        return True
+
+    def wait(self, timeout=None):
+        return
+
+    def get(self, timeout=None):
+        return self.results
+
+######################################################
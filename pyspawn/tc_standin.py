@@ -0,0 +1,148 @@
+import os
+import time
+import tempfile
+import socket
+import threading
+import numpy as np
+import numpy.linalg as la
+
+######################################################
+# local stand-in for a TeraChem server
+######################################################
+
+# tc_standin_client has the interface of the tcpb TCProtobufClient used by
+# the TeraChem potentials (connect, is_available, compute_job_sync, ...) and
+# returns results of the same form, including the CI vector and orbital
+# files in the scratch directory of the server.  The electronic structure
+# is a model: the eigenstates of a numstates x numstates diabatic
+# Hamiltonian (linear vibronic coupling)
+#   V_ii(x) = 0.5 k |x|^2 + g_i x_0 + eps_i
+#   V_ij(x) = lam x_1                       (i != j)
+# with numstates the "cassinglets" option.  The CI vectors are the
+# eigenvectors, the orbitals a numstates x numstates identity.  This allows
+# the potentials and the dispatcher to run without TeraChem.
+# Besides the energy, gradient and ci_vec_overlap jobs, the stand-in knows
+# the energy_gradient_overlap job, which returns the energies, the gradient
+# and (given cvec2file) the overlaps of the new CI vectors with the ones in
+# cvec2file from one solve.  The potentials only send this job to clients
+# with supports_combined_job set (tcpb clients do not have it); with
+# supports_combined_job = False the stand-in rejects it.
+
+
+class tc_standin_client(object):
+    """Client of a stand-in TeraChem server at (host, port)"""
+
+    # model parameters
+    k = 0.01
+    g = 0.02
+    eps = 0.1
+    lam = 0.01
+    # time (in seconds) a job takes, to emulate busy servers
+    delay = 0.0
+    # whether the energy_gradient_overlap job is supported
+    supports_combined_job = True
+
+    # scratch directories of the servers, by (host, port)
+    _scr_dirs = dict()
+    _scr_lock = threading.Lock()
+
+    def __init__(self, host='localhost', port=54321):
+        self.host = host
+        self.port = port
+        self.options = dict()
+        self.connected = False
+        # number of jobs run by this client, by job type
+        self.njobs = dict()
+
+    def connect(self):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def is_available(self):
+        return self.connected
+
+    def update_options(self, **options):
+        self.options.update(options)
+
+    def get_job_scr_dir(self):
+        server = (self.host, self.port)
+        with tc_standin_client._scr_lock:
+            if server not in tc_standin_client._scr_dirs:
+                tc_standin_client._scr_dirs[server] = tempfile.mkdtemp(
+                    prefix="tc_standin_" + str(self.port) + "_")
+            return tc_standin_client._scr_dirs[server]
+
+    def compute_job_sync(self, jobType, geom, unitType, **options):
+        """Run the job jobType ("energy", "gradient", "ci_vec_overlap" or
+        "energy_gradient_overlap") at the geometry geom (a flat list of
+        coordinates in unitType) and return the results dictionary"""
+
+        if not self.connected:
+            raise socket.error("stand-in TeraChem client is not connected")
+        if jobType == "energy_gradient_overlap" and not self.supports_combined_job:
+            raise ValueError("Job type not supported: " + jobType)
+        opts = self.options.copy()
+        opts.update(options)
+        self.njobs[jobType] = self.njobs.get(jobType, 0) + 1
+        if self.delay > 0.0:
+            time.sleep(self.delay)
+
+        x = np.asarray(geom, dtype=np.float64).flatten()
+        if unitType == "angstrom":
+            x = x / 0.529177
+        nstates = opts.get("cassinglets", 2)
+
+        results = dict()
+        results["job_scr_dir"] = self.get_job_scr_dir()
+        results["job_dir"] = results["job_scr_dir"]
+
+        if jobType == "ci_vec_overlap":
+            civecs1 = np.fromfile(opts["cvec1file"]).reshape((nstates, -1))
+            civecs2 = np.fromfile(opts["cvec2file"]).reshape((nstates, -1))
+            results["ci_overlap"] = np.matmul(civecs1, civecs2.T)
+            return results
+        if jobType not in ["energy", "gradient", "energy_gradient_overlap"]:
+            raise ValueError("Job type not supported: " + jobType)
+
+        (e, civecs) = self.solve(x, nstates)
+        results["energy"] = e
+        self.write_files(results, civecs)
+
+        if jobType in ["gradient", "energy_gradient_overlap"]:
+            target = opts.get("castarget", 0)
+            results["gradient"] = self.gradient(x, civecs[target, :]).reshape((-1, 3))
+        if jobType == "energy_gradient_overlap" and "cvec2file" in opts:
+            civecs2 = np.fromfile(opts["cvec2file"]).reshape((nstates, -1))
+            results["ci_overlap"] = np.matmul(civecs, civecs2.T)
+
+        return results
+
+    def diabatic_hamiltonian(self, x, nstates):
+        V = self.lam * x[1] * np.ones((nstates, nstates))
+        for i in range(nstates):
+            V[i, i] = 0.5 * self.k * np.dot(x, x) + self.g * i * x[0] + self.eps * i
+        return V
+
+    def solve(self, x, nstates):
+        """Adiabatic energies and CI vectors (rows) at x"""
+
+        e, c = la.eigh(self.diabatic_hamiltonian(x, nstates))
+        return e, c.T.copy()
+
+    def gradient(self, x, c):
+        """Hellmann-Feynman gradient of the state with CI vector c at x"""
+
+        grad = self.k * x
+        grad[0] += self.g * np.dot(np.arange(c.size), c * c)
+        grad[1] += self.lam * (np.sum(c) ** 2 - np.dot(c, c))
+        return grad
+
+    def write_files(self, results, civecs):
+        scr_dir = results["job_scr_dir"]
+        civecs.tofile(os.path.join(scr_dir, "CIvecs.Singlet.dat"))
+        results["orbfile"] = os.path.join(scr_dir, "c0")
+        np.identity(civecs.shape[0]).tofile(results["orbfile"])
+
+######################################################
@@ -2,7 +2,25 @@ import numpy as np
 import sys
 import math
 from pyspawn.fmsobj import fmsobj
+from pyspawn import h5output
+from pyspawn import h5cache
+from pyspawn import h5writer
 import h5py
+import functools
+import threading
+from collections import OrderedDict
+
+# serializes the access to working.hdf5 when tasks run in parallel threads
+h5_lock = h5cache.lock
+# serializes the access to the rows kept in memory
+_rows_lock = threading.Lock()
+
+
+def _time_key(t):
+    """Key of the time t in the in-memory rows: the h5 lookups match times
+    within 1.0e-6"""
+
+    return int(round(t * 1.0e6))
 
 
 class traj(fmsobj):
@@ -73,6 +91,15 @@ class traj(fmsobj):
         # terachem server instance
         self.tc_port = 0
 
+        # number of full step (and of half step) rows of the output kept in
+        # memory for the get_*_from_h5 lookups
+        self.h5_buffer_size = 200
+        # the most recent rows written by h5_output, by time
+        self._h5_rows = OrderedDict()
+        self._h5_rows_half_step = OrderedDict()
+        # whether the creation of the h5 group has been queued
+        self._h5_group_queued = False
+
     def set_time(self, t):
         self.time = t
 
@@ -424,6 +451,12 @@ class traj(fmsobj):
     def set_tc_port(self, port):
         self.tc_port = port
 
+    def get_h5_buffer_size(self):
+        return self.h5_buffer_size
+
+    def set_h5_buffer_size(self, n):
+        self.h5_buffer_size = n
+
     def init_traj(self, t, ndims, pos, mom, wid, m, nstates, istat, lab):
         """Initializes trajectory, mainly used for tests"""
 
@@ -504,6 +537,7 @@ class traj(fmsobj):
 
         # copying port for terachem jobs
         self.set_tc_port(parent.tc_port)
+        self.set_h5_buffer_size(parent.get_h5_buffer_size())
 
     def init_centroid(self, existing, child, label):
         ts = child.get_timestep()
@@ -549,6 +583,7 @@ class traj(fmsobj):
 
         # copying port for tc job
         self.set_tc_port(existing.tc_port)
+        self.set_h5_buffer_size(child.get_h5_buffer_size())
 
     def rescale_momentum(self, v_parent):
         """ Computing kinetic energy of parent.  Remember that, at this point,
@@ -855,13 +890,8 @@ class traj(fmsobj):
             cbackprop = ""
         else:
             cbackprop = "backprop_"
-        if "_a_" not in self.get_label():
-            traj_or_cent = "traj_"
-        else:
-            traj_or_cent = "cent_"
         if len(self.h5_datasets) == 0:
             self.init_h5_datasets()
-        filename = "working.hdf5"
         #         extensions = [3,2,1,0]
         #         for i in extensions :
         #             if i==0:
@@ -879,49 +909,133 @@ class traj(fmsobj):
         #                         shutil.copy2(filename, filename2)
         #                     else:
         #                         shutil.move(filename, filename2)
-        h5f = h5py.File(filename, "a")
-        groupname = traj_or_cent + self.label
-        if groupname not in h5f.keys():
-            self.create_h5_traj(h5f, groupname)
-        trajgrp = h5f.get(groupname)
+        groupname = self.get_h5_groupname()
+        if not self._h5_group_queued:
+            h5writer.submit(functools.partial(self.create_h5_traj_if_missing, groupname))
+            self._h5_group_queued = True
         all_datasets = self.h5_datasets.copy()
         if not zdont_half_step:
             all_datasets.update(self.h5_datasets_half_step)
+        row = dict()
+        rows = []
         for key in all_datasets:
             n = all_datasets[key]
             #             print "key =", key
-            dset = trajgrp.get(key)
-            l = dset.len()
-            dset.resize(l + 1, axis=0)
-            if not zbackprop:
-                ipos = l
-            else:
-                ipos = 0
-                dset[1:(l + 1), 0:n] = dset[0:l, 0:n]
             getcom = "self.get_" + cbackprop + key + "()"
             #             print "getcom =", getcom
             tmp = eval(getcom)
-            #             print "ipos =", ipos
+            data = np.zeros(n)
             if n != 1:
-                dset[ipos, 0:n] = tmp[0:n]
+                data[0:n] = tmp[0:n]
             else:
-                dset[ipos, 0] = tmp
-        h5f.flush()
-        h5f.close()
+                data[0] = tmp
+            row[key] = data
+            # backpropagation rows are appended to datasets of their own (in
+            # reverse time order) until mintime is reached
+            rows.append((cbackprop + key, data))
+        with _rows_lock:
+            self.buffer_h5_row(row, zbackprop, zdont_half_step)
+
+        # the rows are written by the write-behind queue
+        h5writer.append_rows(groupname, rows)
+        if zbackprop:
+            h5writer.submit(functools.partial(self.shift_h5_index, groupname,
+                                              zdont_half_step))
+            if self.get_backprop_time() < self.get_mintime() + 1.0e-6:
+                h5writer.submit(functools.partial(self.consolidate_h5_backprop,
+                                                  groupname))
+
+    def get_h5_groupname(self):
+        """Name of the h5 group of the trajectory or centroid"""
 
-    def create_h5_traj(self, h5f, groupname):
+        if "_a_" not in self.get_label():
+            traj_or_cent = "traj_"
+        else:
+            traj_or_cent = "cent_"
+        return traj_or_cent + self.label
+
+    def create_h5_traj_if_missing(self, groupname):
+        """create the trajectory group in hdf5 output file, unless it is
+        there already (after a restart)"""
+
+        cache = h5cache.get_cache()
+        if cache.get_group(groupname) is None:
+            self.create_h5_traj(cache, groupname)
+
+    def shift_h5_index(self, groupname, zdont_half_step):
+        """Counts a backpropagation row, which precedes the rows already
+        written, in the index attributes of the h5 group groupname"""
+
+        attrs = h5cache.get_cache().get_group(groupname).attrs
+        if "index_offset" in attrs:
+            attrs["index_offset"] += 1
+            if not zdont_half_step:
+                attrs["index_offset_half_step"] += 1
+
+    def consolidate_h5_backprop(self, groupname):
+        """Moves the backpropagation rows of the h5 group groupname in front
+        of the forward rows, once backpropagation has reached mintime, and
+        removes the backpropagation datasets"""
+
+        cache = h5cache.get_cache()
+        for key in list(cache.get_group(groupname).keys()):
+            back = cache.get_dataset(groupname, "backprop_" + key)
+            if back is None:
+                continue
+            back = h5output.read_rows(back)
+            nb = back.shape[0]
+            dset = cache.get_dataset(groupname, key)
+            forward = h5output.read_rows(dset)
+            l = forward.shape[0]
+            h5output.set_length(dset, l + nb)
+            dset[nb:(l + nb), :] = forward
+            dset[0:nb, :] = back[::-1, :]
+            cache.delete_dataset(groupname, "backprop_" + key)
+
+    def buffer_h5_row(self, row, zbackprop, zdont_half_step):
+        """Keeps the full step and the half step data of the row just queued
+        for the h5 file in memory.  The oldest rows are dropped when there are
+        more than h5_buffer_size"""
+
+        buffers = [(self._h5_rows, self.h5_datasets, "time")]
+        if not zdont_half_step:
+            buffers.append((self._h5_rows_half_step, self.h5_datasets_half_step,
+                            "time_half_step"))
+        for (rows, datasets, time_key) in buffers:
+            if time_key not in row:
+                continue
+            t = _time_key(row[time_key][0])
+            # a time present in both directions is read from the forward
+            # row (which comes last in the datasets)
+            if zbackprop and t in rows:
+                continue
+            rows.pop(t, None)
+            rows[t] = dict((key, row[key]) for key in datasets)
+            while len(rows) > self.h5_buffer_size:
+                rows.popitem(last=False)
+
+    def get_h5_row(self, t, zhalf_step=False):
+        """Data written to the h5 file at the (full or half step) time t if
+        still kept in memory, None otherwise"""
+
+        if zhalf_step:
+            rows = self._h5_rows_half_step
+        else:
+            rows = self._h5_rows
+        with _rows_lock:
+            return rows.get(_time_key(t))
+
+    def create_h5_traj(self, cache, groupname):
         """create a new trajectory group in hdf5 output file"""
 
-        trajgrp = h5f.create_group(groupname)
+        trajgrp = cache.create_group(groupname)
         for key in self.h5_datasets:
             n = self.h5_datasets[key]
             #             print "key, n ", key, n
-            trajgrp.create_dataset(key, (0, n), maxshape=(None, n),
-                                   dtype="float64")
+            h5output.create_dataset(trajgrp, key, n)
         for key in self.h5_datasets_half_step:
             n = self.h5_datasets_half_step[key]
-            trajgrp.create_dataset(key, (0, n), maxshape=(None, n),
-                                   dtype="float64")
+            h5output.create_dataset(trajgrp, key, n)
         # add some metadata
         trajgrp.attrs["istate"] = self.istate
         trajgrp.attrs["masses"] = self.masses
@@ -931,87 +1045,133 @@ class traj(fmsobj):
         trajgrp.attrs["spawnthresh"] = self.spawnthresh
         if hasattr(self, "atoms"):
             trajgrp.attrs["atoms"] = self.atoms
+        # time to row index: the full step rows are on a grid of timestep
+        # through firsttime, the half step rows half a step later.  The
+        # offsets count the backpropagation rows, which precede the rest
+        trajgrp.attrs["index_timestep"] = self.timestep
+        trajgrp.attrs["index_time0"] = self.firsttime
+        trajgrp.attrs["index_time0_half_step"] = self.firsttime + 0.5 * self.timestep
+        trajgrp.attrs["index_offset"] = 0
+        trajgrp.attrs["index_offset_half_step"] = 0
 
     def get_data_at_time_from_h5(self, t, dset_name):
         """Pulls data at full time step from h5 file"""
 
-        h5f = h5py.File("working.hdf5", "r")
-        if "_a_" not in self.get_label():
-            traj_or_cent = "traj_"
-        else:
-            traj_or_cent = "cent_"
-        groupname = traj_or_cent + self.label
-        trajgrp = h5f.get(groupname)
-        dset_time = trajgrp["time"][:]
-        #         print "size", dset_time.size
-        ipoint = -1
-        for i in range(len(dset_time)):
-            if (dset_time[i] < t + 1.0e-6) and (dset_time[i] > t - 1.0e-6):
-                ipoint = i
-        #                 print "dset_time[i] ", dset_time[i]
-        #                 print "i ", i
-        dset = trajgrp[dset_name][:]
-        data = np.zeros(len(dset[ipoint, :]))
-        data = dset[ipoint, :]
+        row = self.get_h5_row(t)
+        if row is not None:
+            return row[dset_name].copy()
+
+        # the rows still queued for the file are written first
+        h5writer.barrier()
+        with h5_lock:
+            groupname = self.get_h5_groupname()
+            ipoint = self.get_h5_row_index(groupname, t)
+            data = self.read_h5_row(groupname, dset_name, ipoint)
         #         print "dset[ipoint,:] ", dset[ipoint,:]
-        h5f.close()
         return data
 
+    def get_h5_row_index(self, groupname, t, zhalf_step=False):
+        """Row of the (full or half step) time t in the datasets of the h5
+        group groupname.  The row follows from the index attributes of the
+        group; the time dataset is only scanned if they are missing (files
+        of older versions) or the time is not on the grid.  As the scan,
+        returns -1 if t is not found"""
+
+        if zhalf_step:
+            suffix = "_half_step"
+        else:
+            suffix = ""
+        name = "time" + suffix
+        cache = h5cache.get_cache()
+        attrs = cache.get_group(groupname).attrs
+        if "index_time0" + suffix in attrs and attrs["index_timestep"] > 0.0:
+            ipoint = attrs["index_offset" + suffix] \
+                + int(round((t - attrs["index_time0" + suffix]) / attrs["index_timestep"]))
+            if 0 <= ipoint < self.get_h5_merged_len(groupname, name) \
+                    and abs(self.read_h5_row(groupname, name, ipoint)[0] - t) < 1.0e-6:
+                return ipoint
+        times = h5output.read_rows(cache.get_dataset(groupname, name))[:, 0]
+        back = cache.get_dataset(groupname, "backprop_" + name)
+        if back is not None:
+            times = np.concatenate((h5output.read_rows(back)[::-1, 0], times))
+        ipoints = np.nonzero(np.absolute(times - t) < 1.0e-6)[0]
+        if len(ipoints) > 0:
+            return ipoints[-1]
+        return -1
+
+    def get_h5_merged_len(self, groupname, dset_name):
+        """Number of rows of the dataset dset_name of the h5 group groupname,
+        including the backpropagation rows not yet consolidated"""
+
+        cache = h5cache.get_cache()
+        l = h5output.get_length(cache.get_dataset(groupname, dset_name))
+        back = cache.get_dataset(groupname, "backprop_" + dset_name)
+        if back is not None:
+            l += h5output.get_length(back)
+        return l
+
+    def read_h5_row(self, groupname, dset_name, ipoint):
+        """Row ipoint of the dataset dset_name of the h5 group groupname in
+        time order, with the backpropagation rows not yet consolidated in
+        front of the forward rows.  -1 is the last row"""
+
+        cache = h5cache.get_cache()
+        back = cache.get_dataset(groupname, "backprop_" + dset_name)
+        if back is not None:
+            nb = h5output.get_length(back)
+        else:
+            nb = 0
+        if ipoint < 0:
+            ipoint += self.get_h5_merged_len(groupname, dset_name)
+        if ipoint < nb:
+            return back[nb - 1 - ipoint, :]
+        return cache.get_dataset(groupname, dset_name)[ipoint - nb, :]
+
     def get_all_qm_data_at_time_from_h5(self, t, suffix=""):
         """Pulls qm data from h5 file at full time step"""
 
-        h5f = h5py.File("working.hdf5", "r")
-        if "_a_" not in self.get_label():
-            traj_or_cent = "traj_"
-        else:
-            traj_or_cent = "cent_"
-        groupname = traj_or_cent + self.label
-        trajgrp = h5f.get(groupname)
-        dset_time = trajgrp["time"][:]
-        #         print "size", dset_time.size
-        ipoint = -1
-        for i in range(len(dset_time)):
-            if (dset_time[i] < t + 1.0e-6) and (dset_time[i] > t - 1.0e-6):
-                ipoint = i
-        #                 print "dset_time[i] ", dset_time[i]
-        #                 print "i ", i
-        for dset_name in self.h5_datasets:
-            dset = trajgrp[dset_name][:]
-            data = np.zeros(len(dset[ipoint, :]))
-            data = dset[ipoint, :]
-            comm = "self." + dset_name + "_qm" + suffix + " = data"
-            exec (comm)
+        row = self.get_h5_row(t)
+        if row is not None:
+            for dset_name in self.h5_datasets:
+                data = row[dset_name].copy()
+                comm = "self." + dset_name + "_qm" + suffix + " = data"
+                exec (comm)
+            return
+
+        # the rows still queued for the file are written first
+        h5writer.barrier()
+        with h5_lock:
+            groupname = self.get_h5_groupname()
+            ipoint = self.get_h5_row_index(groupname, t)
+            for dset_name in self.h5_datasets:
+                data = self.read_h5_row(groupname, dset_name, ipoint)
+                comm = "self." + dset_name + "_qm" + suffix + " = data"
+                exec (comm)
         #             print "comm ", comm
         #             print "dset[ipoint,:] ", dset[ipoint,:]
-        h5f.close()
 
     def get_all_qm_data_at_time_from_h5_half_step(self, t):
         """Pulls data from h5 file at half time step"""
 
-        h5f = h5py.File("working.hdf5", "r")
-        if "_a_" not in self.get_label():
-            traj_or_cent = "traj_"
-        else:
-            traj_or_cent = "cent_"
-        groupname = traj_or_cent + self.label
-        trajgrp = h5f.get(groupname)
-        dset_time = trajgrp["time_half_step"][:]
-        #         print "size", dset_time.size
-        ipoint = -1
-        for i in range(len(dset_time)):
-            if (dset_time[i] < t + 1.0e-6) and (dset_time[i] > t - 1.0e-6):
-                ipoint = i
-        #                 print "dset_time[i] ", dset_time[i]
-        #                 print "i ", i
-        for dset_name in self.h5_datasets_half_step:
-            dset = trajgrp[dset_name][:]
-            data = np.zeros(len(dset[ipoint, :]))
-            data = dset[ipoint, :]
-            comm = "self." + dset_name + "_qm = data"
-            exec (comm)
-            # print "comm ", comm
-            # print "dset[ipoint,:] ", dset[ipoint,:]
-        h5f.close()
+        row = self.get_h5_row(t, zhalf_step=True)
+        if row is not None:
+            for dset_name in self.h5_datasets_half_step:
+                data = row[dset_name].copy()
+                comm = "self." + dset_name + "_qm = data"
+                exec (comm)
+            return
+
+        # the rows still queued for the file are written first
+        h5writer.barrier()
+        with h5_lock:
+            groupname = self.get_h5_groupname()
+            ipoint = self.get_h5_row_index(groupname, t, zhalf_step=True)
+            for dset_name in self.h5_datasets_half_step:
+                data = self.read_h5_row(groupname, dset_name, ipoint)
+                comm = "self." + dset_name + "_qm = data"
+                exec (comm)
+                # print "comm ", comm
+                # print "dset[ipoint,:] ", dset[ipoint,:]
 
     def compute_tdc(self, Win):
         """Computes derivative coupling matrix elements
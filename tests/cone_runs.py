@@ -0,0 +1,112 @@
+# short runs of the test_cone potential (two dimensions, two states, one
+# spawn) shared by the test_cone_* scripts.  A run is made in a directory
+# of its own; the scripts run the option under test next to a reference run
+# and compare the sim.hdf5 outputs of the two
+import os
+import shutil
+import h5py
+import numpy as np
+import pyspawn
+
+t0 = 0.0
+
+ts = 0.1
+
+# the spawn happens a little after 20.0
+tfinal = 25.0
+
+traj_params = {
+    "time": t0,
+    "timestep": ts,
+    "maxtime": tfinal,
+    "spawnthresh": (0.5 * np.pi) / ts / 20.0,
+    "istate": 1,
+    "widths": np.asarray([6.0, 6.0]),
+    "masses": np.asarray([1822.0, 1822.0]),
+    "positions": np.asarray([0.45, 0.1]),
+    "momenta": np.asarray([-5.0, 0.0]),
+    }
+
+sim_params = {
+    "quantum_time": traj_params["time"],
+    "timestep": traj_params["timestep"],
+    "max_quantum_time": traj_params["maxtime"],
+    "qm_energy_shift": -5.18,
+    }
+
+
+def run(dirname, qm_prop="fulldiag", sim_extra=None, traj_extra=None,
+        tbfs=None):
+    """Run the simulation with the quantum integrator qm_prop and the
+    parameters sim_extra and traj_extra added, in the directory dirname
+    (removed first if present).  tbfs is the list of the parameters of
+    the initial TBFs (labeled 00, 01, ...), which are added to the ones of
+    traj_extra; a single TBF by default.  Returns the simulation"""
+
+    if os.path.isdir(dirname):
+        shutil.rmtree(dirname)
+    os.mkdir(dirname)
+    cwd = os.getcwd()
+    os.chdir(dirname)
+    try:
+        pyspawn.import_methods.into_simulation(
+            getattr(pyspawn.qm_integrator, qm_prop))
+        pyspawn.import_methods.into_simulation(pyspawn.qm_hamiltonian.adiabatic)
+        pyspawn.import_methods.into_traj(pyspawn.potential.test_cone)
+        pyspawn.import_methods.into_traj(pyspawn.classical_integrator.vv)
+
+        if tbfs is None:
+            tbfs = [dict()]
+        sim = pyspawn.simulation()
+        for (i, tbf) in enumerate(tbfs):
+            tparams = dict(traj_params)
+            if traj_extra is not None:
+                tparams.update(traj_extra)
+            tparams.update(tbf)
+            traj1 = pyspawn.traj(2, 2)
+            traj1.set_parameters(tparams)
+            traj1.set_label("%02d" % i)
+            sim.add_traj(traj1)
+
+        sparams = dict(sim_params)
+        sparams["qm_amplitudes"] = np.ones(len(tbfs), dtype=np.complex128)
+        if sim_extra is not None:
+            sparams.update(sim_extra)
+        sim.set_parameters(sparams)
+
+        sim.propagate()
+    finally:
+        os.chdir(cwd)
+    return sim
+
+
+def read_output(dirname):
+    """The datasets of the sim.hdf5 output of the run in dirname, by path"""
+
+    data = dict()
+    h5f = h5py.File(os.path.join(dirname, "sim.hdf5"), "r")
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            data[name] = obj[()]
+
+    h5f.visititems(visit)
+    h5f.close()
+    return data
+
+
+def compare(dirname, refname):
+    """Largest difference between the sim.hdf5 outputs of the runs in
+    dirname and refname.  Asserts that the datasets of the reference are
+    all there, with the same shapes"""
+
+    data = read_output(dirname)
+    ref = read_output(refname)
+    maxdiff = 0.0
+    for path in sorted(ref):
+        assert path in data, path + " missing"
+        assert data[path].shape == ref[path].shape, path + " shape differs"
+        if data[path].size > 0:
+            maxdiff = max(maxdiff, np.amax(np.absolute(data[path] - ref[path])))
+    print "### " + dirname + " vs " + refname + ": max difference", maxdiff
+    return maxdiff
@@ -0,0 +1,26 @@
+# runs the test_cone simulation and checks that the backpropagation rows
+# of the spawned TBFs are consolidated with their forward rows in the
+# output: no backprop_ datasets are left and the times are in order
+import os
+import sys
+import h5py
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cone_runs
+
+cone_runs.run("backprop")
+
+h5f = h5py.File(os.path.join("backprop", "sim.hdf5"), "r")
+nbackprop = 0
+for groupname in h5f:
+    grp = h5f[groupname]
+    assert not any(key.startswith("backprop_") for key in grp), groupname
+    if "time" not in grp:
+        continue
+    times = grp["time"][:, 0]
+    assert (np.diff(times) > 0.0).all(), groupname
+    # rows before the spawn
+    nbackprop += np.count_nonzero(times < grp.attrs["index_time0"] - 1.0e-6)
+h5f.close()
+
+assert nbackprop > 0
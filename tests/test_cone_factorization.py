@@ -0,0 +1,41 @@
+# runs the test_cone simulation from three overlapping TBFs on the same
+# state, with S entering Heff through its Cholesky factorization and
+# through canonical orthogonalization, and compares the outputs with the
+# one of the explicit inverse of S.  With two nearly coincident TBFs, the
+# canonical orthogonalization drops their near linearly dependent
+# direction at each factorization of S
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cone_runs
+
+# short runs, before the spawn
+extra = {"max_quantum_time": 5.0}
+traj_extra = {"maxtime": 5.0}
+
+tbfs = [{"positions": np.asarray([0.45, 0.1])},
+        {"positions": np.asarray([0.5, 0.15])},
+        {"positions": np.asarray([0.4, 0.2])}]
+
+cone_runs.run("S_inv", sim_extra=dict(extra, S_factorization="inv"),
+              traj_extra=traj_extra, tbfs=tbfs)
+
+for f in ["cholesky", "canonical"]:
+    sim = cone_runs.run("S_" + f, sim_extra=dict(extra, S_factorization=f),
+                        traj_extra=traj_extra, tbfs=tbfs)
+    assert cone_runs.compare("S_" + f, "S_inv") < 1.0e-10
+assert sim.get_S_canonical_ndrop() == 0
+
+# S is far from the identity
+S = cone_runs.read_output("S_inv")["sim/S"][0].reshape(3, 3)
+assert np.linalg.cond(S) > 10.0
+
+tbfs[1]["positions"] = np.asarray([0.45 + 1.0e-4, 0.1])
+
+sim = cone_runs.run("S_canonical_dup", sim_extra=dict(extra, S_factorization="canonical"),
+                    traj_extra=traj_extra, tbfs=tbfs)
+# S is factorized once per quantum time (the second half step reuses it)
+ntimes = len(cone_runs.read_output("S_canonical_dup")["sim/quantum_time"])
+print "### directions dropped", sim.get_S_canonical_ndrop(), "at", ntimes, "times"
+assert sim.get_S_canonical_ndrop() == ntimes
@@ -0,0 +1,12 @@
+# runs the test_cone simulation without the in-memory ring buffer of the
+# trajectory rows (all the history is read back from working.hdf5, through
+# the time index and the backpropagation rows), and compares its output
+# with the one of the run with the default buffer
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cone_runs
+
+cone_runs.run("buffered")
+cone_runs.run("unbuffered", traj_extra={"h5_buffer_size": 0})
+assert cone_runs.compare("unbuffered", "buffered") == 0.0
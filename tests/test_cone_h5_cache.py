@@ -0,0 +1,17 @@
+# runs the test_cone simulation reading all the trajectory history back
+# from working.hdf5, and checks that the process opened the file once for
+# the run and closed it at the end
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cone_runs
+from pyspawn import h5cache
+
+cache = h5cache.get_cache()
+nopen = cache.nopen
+
+cone_runs.run("cache", traj_extra={"h5_buffer_size": 0})
+
+print "### working.hdf5 opened", cache.nopen - nopen, "times"
+assert cache.nopen == nopen + 1
+assert not cache.is_open()
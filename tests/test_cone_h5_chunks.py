@@ -0,0 +1,31 @@
+# runs the test_cone simulation with small gzip compressed chunks, and
+# compares its output with the one of the default uncompressed chunks.
+# The preallocated rows are trimmed from both outputs, and the chunks of
+# the sim datasets that grow wider with the spawn span their whole width
+import os
+import sys
+import h5py
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cone_runs
+
+cone_runs.run("chunks")
+cone_runs.run("chunks_gzip", sim_extra={"h5_compression": "gzip",
+                                        "h5_shuffle": True,
+                                        "h5_chunk_bytes": 1024})
+assert cone_runs.compare("chunks_gzip", "chunks") == 0.0
+
+
+def check_trimmed(name, obj):
+    if isinstance(obj, h5py.Dataset) and "length" in obj.attrs:
+        assert obj.len() == obj.attrs["length"], obj.name + " is not trimmed"
+        assert obj.chunks[1] == obj.shape[1], obj.name + " chunks are too narrow"
+
+for dirname in ["chunks", "chunks_gzip"]:
+    h5f = h5py.File(os.path.join(dirname, "sim.hdf5"), "r")
+    h5f.visititems(check_trimmed)
+    h5f.close()
+
+size = os.path.getsize(os.path.join("chunks", "sim.hdf5"))
+size_gzip = os.path.getsize(os.path.join("chunks_gzip", "sim.hdf5"))
+print "### output size, uncompressed and gzip", size, size_gzip
+assert size_gzip < size
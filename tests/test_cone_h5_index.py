@@ -0,0 +1,29 @@
+# runs the test_cone simulation and checks the time index of the
+# trajectory and centroid groups of the output: the row of each time
+# follows from the index attributes of its group, also for the spawned
+# TBFs, whose backpropagation rows precede the forward ones
+import os
+import sys
+import h5py
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cone_runs
+
+cone_runs.run("index")
+
+h5f = h5py.File(os.path.join("index", "sim.hdf5"), "r")
+ngroups = 0
+for groupname in h5f:
+    attrs = h5f[groupname].attrs
+    if "index_timestep" not in attrs:
+        continue
+    ngroups += 1
+    for suffix in ["", "_half_step"]:
+        times = h5f[groupname]["time" + suffix][:, 0]
+        ipoints = attrs["index_offset" + suffix] \
+            + np.rint((times - attrs["index_time0" + suffix]) / attrs["index_timestep"])
+        assert (ipoints == np.arange(len(times))).all(), groupname + suffix
+h5f.close()
+
+# the parent, the child and their centroid
+assert ngroups == 3
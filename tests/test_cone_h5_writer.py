@@ -0,0 +1,26 @@
+# runs the test_cone simulation with the hdf5 output written right away and
+# through the write-behind queue, and compares the outputs.  The queue
+# writes the same rows in fewer batches (the restart files are written by
+# the queue as well, so the loop does not wait for it at each step)
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cone_runs
+from pyspawn import h5writer
+
+writer = h5writer.get_writer()
+
+(nbatch, nrows) = (writer.nbatch, writer.nrows)
+cone_runs.run("write_now", sim_extra={"h5_write_behind": False})
+(nbatch_now, nrows_now) = (writer.nbatch - nbatch, writer.nrows - nrows)
+
+(nbatch, nrows) = (writer.nbatch, writer.nrows)
+cone_runs.run("write_behind", sim_extra={"h5_write_behind": True})
+(nbatch_behind, nrows_behind) = (writer.nbatch - nbatch, writer.nrows - nrows)
+
+assert cone_runs.compare("write_behind", "write_now") == 0.0
+
+print "### batches and rows written right away", nbatch_now, nrows_now
+print "### batches and rows written behind", nbatch_behind, nrows_behind
+assert nrows_behind == nrows_now
+assert nbatch_behind < nbatch_now
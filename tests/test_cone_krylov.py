@@ -0,0 +1,23 @@
+# runs the test_cone simulation with the Krylov subspace quantum integrator,
+# from one TBF and from three overlapping TBFs, and compares its outputs
+# with the ones of the full diagonalization integrator
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cone_runs
+
+cone_runs.run("fulldiag")
+cone_runs.run("krylov", "krylov")
+assert cone_runs.compare("krylov", "fulldiag") < 1.0e-12
+
+# three overlapping TBFs on both states: the Hessenberg matrices of the
+# Arnoldi iterations are 3 x 3 and not normal
+tbfs = [{"positions": np.asarray([0.45, 0.1])},
+        {"positions": np.asarray([0.5, 0.15])},
+        {"positions": np.asarray([0.4, 0.2]), "istate": 0}]
+extra = {"max_quantum_time": 5.0}
+traj_extra = {"maxtime": 5.0}
+cone_runs.run("fulldiag_3", sim_extra=extra, traj_extra=traj_extra, tbfs=tbfs)
+cone_runs.run("krylov_3", "krylov", sim_extra=extra, traj_extra=traj_extra, tbfs=tbfs)
+assert cone_runs.compare("krylov_3", "fulldiag_3") < 1.0e-12
@@ -0,0 +1,11 @@
+# runs the test_cone simulation with the fourth-order Magnus quantum
+# integrator and compares its output with the one of the full
+# diagonalization integrator (Heff is interpolated within the step)
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cone_runs
+
+cone_runs.run("fulldiag")
+cone_runs.run("magnus", "magnus")
+assert cone_runs.compare("magnus", "fulldiag") < 2.0e-4
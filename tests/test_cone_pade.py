@@ -0,0 +1,19 @@
+# runs the test_cone simulation with the scaling-and-squaring Pade quantum
+# integrator and compares its output with the one of the full
+# diagonalization integrator.  The norm drift of the Pade propagators is
+# written to the output (by the Pade integrator only)
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cone_runs
+
+cone_runs.run("fulldiag")
+cone_runs.run("pade", "pade")
+assert cone_runs.compare("pade", "fulldiag") < 1.0e-12
+
+drift = cone_runs.read_output("pade")["sim/qm_norm_drift"]
+print "### largest norm drift", drift.max()
+assert drift.max() < 1.0e-10
+
+# the other integrators do not write it
+assert "sim/qm_norm_drift" not in cone_runs.read_output("fulldiag")
@@ -0,0 +1,11 @@
+# runs the test_cone simulation with the embedded Dormand-Prince 5(4)
+# quantum integrator and compares its output with the one of the full
+# diagonalization integrator (the substeps are controlled to rk45_tol)
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cone_runs
+
+cone_runs.run("fulldiag")
+cone_runs.run("rk45", "rk45")
+assert cone_runs.compare("rk45", "fulldiag") < 1.0e-6
@@ -0,0 +1,32 @@
+# runs the test_cone simulation from three TBFs far apart in phase space
+# (two on the same state, one on the other state) with the phase-space
+# pair screening, and compares the output with the one of the unscreened
+# run.  The screened pairs are left out of S and H instead of being
+# computed as tiny overlaps
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cone_runs
+
+# short runs, before the spawn
+extra = {"max_quantum_time": 5.0}
+traj_extra = {"maxtime": 5.0}
+
+# the overlaps of the distant pairs are about 1e-11
+tbfs = [{"positions": np.asarray([0.45, 0.1])},
+        {"positions": np.asarray([0.45, 3.0])},
+        {"positions": np.asarray([0.45, -2.8]), "istate": 0}]
+
+cone_runs.run("dense", sim_extra=extra, traj_extra=traj_extra, tbfs=tbfs)
+cone_runs.run("screened", sim_extra=dict(extra, pair_screen_thresh=1.0e-8),
+              traj_extra=traj_extra, tbfs=tbfs)
+assert cone_runs.compare("screened", "dense") < 1.0e-9
+
+dense = cone_runs.read_output("dense")
+screened = cone_runs.read_output("screened")
+for key in ["S", "H"]:
+    nzero = np.count_nonzero(dense["sim/" + key] == 0.0)
+    nzero_screened = np.count_nonzero(screened["sim/" + key] == 0.0)
+    print "### zero elements of", key, "unscreened and screened", nzero, nzero_screened
+    assert nzero_screened > nzero
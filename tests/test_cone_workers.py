@@ -0,0 +1,18 @@
+# runs the test_cone simulation with the ready propagation tasks run by
+# three worker threads (taken from the task heap by priority), and compares
+# its output with the one of the serial run.  The worker threads are
+# stopped when propagate returns
+import os
+import sys
+import threading
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cone_runs
+
+cone_runs.run("serial", sim_extra={"num_workers": 1})
+nthreads = threading.active_count()
+
+cone_runs.run("workers", sim_extra={"num_workers": 3})
+assert cone_runs.compare("workers", "serial") == 0.0
+
+print "### threads before and after the parallel run", nthreads, threading.active_count()
+assert threading.active_count() == nthreads
@@ -0,0 +1,75 @@
+# runs the TeraChem CAS potential on stand-in TeraChem servers (no TeraChem
+# needed), with the jobs of the TBFs dispatched to two servers
+import numpy as np
+import pyspawn
+import pyspawn.general
+import pyspawn.tc_dispatcher
+from pyspawn.tc_standin import tc_standin_client
+
+pyspawn.import_methods.into_simulation(pyspawn.qm_integrator.fulldiag)
+pyspawn.import_methods.into_simulation(pyspawn.qm_hamiltonian.adiabatic)
+pyspawn.import_methods.into_traj(pyspawn.potential.terachem_cas)
+pyspawn.import_methods.into_traj(pyspawn.classical_integrator.vv)
+
+# two stand-in servers, a job takes 0.01 s
+tc_standin_client.delay = 0.01
+pyspawn.tc_dispatcher.set_servers([("localhost", 54321), ("localhost", 54322)],
+                                  client_class=tc_standin_client)
+
+t0 = 0.0
+
+ts = 10.0
+
+tfinal = 400.0
+
+atoms = ['H', 'H']
+
+numdims = 6
+
+numstates = 2
+
+tc_options = {
+    "method":       'hf',
+    "basis":        '6-31g',
+    "atoms":        atoms,
+    "casscf":       "yes",
+    "cassinglets":  numstates,
+    "castargetmult": 1,
+    }
+
+traj_params = {
+    "time": t0,
+    "timestep": ts,
+    "maxtime": tfinal,
+    "spawnthresh": (0.5 * np.pi) / ts / 20.0,
+    "istate": 1,
+    "widths": 6.0 * np.ones(numdims),
+    "atoms": atoms,
+    "masses": 1822.0 * np.ones(numdims),
+    "positions": np.asarray([0.0, 0.2, 0.0, 0.0, 0.0, 0.0]),
+    "momenta": np.asarray([-25.0, 0.0, 0.0, 0.0, 0.0, 0.0]),
+    "tc_options": tc_options
+    }
+
+sim_params = {
+    "quantum_time": traj_params["time"],
+    "timestep": traj_params["timestep"],
+    "max_quantum_time": traj_params["maxtime"],
+    "qm_amplitudes": np.ones(1, dtype=np.complex128),
+    "qm_energy_shift": 0.0,
+    "num_workers": 2,
+}
+
+pyspawn.general.check_files()
+
+traj1 = pyspawn.traj(numdims, numstates)
+traj1.set_parameters(traj_params)
+
+sim = pyspawn.simulation()
+sim.add_traj(traj1)
+sim.set_parameters(sim_params)
+
+sim.propagate()
+
+print "jobs per server: ", pyspawn.tc_dispatcher.get_dispatcher().get_njobs()
+print "connections per server: ", pyspawn.tc_dispatcher.get_dispatcher().clients.get_nconnect()
@@ -0,0 +1,102 @@
+# runs the TeraChem CAS potential on a stand-in TeraChem server without the
+# energy_gradient_overlap job (like tcpb): the potential never sends it and
+# uses the energy, gradient and ci_vec_overlap jobs, also after the
+# connection to the server is renewed.  The CI vector and orbital files
+# written for the jobs are removed afterwards
+import os
+import numpy as np
+import pyspawn
+import pyspawn.general
+import pyspawn.tc_dispatcher
+from pyspawn.tc_standin import tc_standin_client
+
+pyspawn.import_methods.into_simulation(pyspawn.qm_integrator.fulldiag)
+pyspawn.import_methods.into_simulation(pyspawn.qm_hamiltonian.adiabatic)
+pyspawn.import_methods.into_traj(pyspawn.potential.terachem_cas)
+pyspawn.import_methods.into_traj(pyspawn.classical_integrator.vv)
+
+# requests sent to the server, by job type (including the rejected ones)
+requests = dict()
+
+
+class counting_client(tc_standin_client):
+    supports_combined_job = False
+
+    def compute_job_sync(self, jobType, geom, unitType, **options):
+        requests[jobType] = requests.get(jobType, 0) + 1
+        return tc_standin_client.compute_job_sync(self, jobType, geom,
+                                                  unitType, **options)
+
+pyspawn.tc_dispatcher.set_servers([("localhost", 54321)],
+                                  client_class=counting_client)
+
+t0 = 0.0
+
+ts = 10.0
+
+tfinal = 100.0
+
+atoms = ['H', 'H']
+
+numdims = 6
+
+numstates = 2
+
+tc_options = {
+    "method":       'hf',
+    "basis":        '6-31g',
+    "atoms":        atoms,
+    "casscf":       "yes",
+    "cassinglets":  numstates,
+    "castargetmult": 1,
+    }
+
+traj_params = {
+    "time": t0,
+    "timestep": ts,
+    "maxtime": tfinal,
+    "spawnthresh": (0.5 * np.pi) / ts / 20.0,
+    "istate": 1,
+    "widths": 6.0 * np.ones(numdims),
+    "atoms": atoms,
+    "masses": 1822.0 * np.ones(numdims),
+    "positions": np.asarray([0.0, 0.2, 0.0, 0.0, 0.0, 0.0]),
+    "momenta": np.asarray([-25.0, 0.0, 0.0, 0.0, 0.0, 0.0]),
+    "tc_options": tc_options
+    }
+
+sim_params = {
+    "quantum_time": traj_params["time"],
+    "timestep": traj_params["timestep"],
+    "max_quantum_time": traj_params["maxtime"],
+    "qm_amplitudes": np.ones(1, dtype=np.complex128),
+    "qm_energy_shift": 0.0,
+}
+
+pyspawn.general.check_files()
+
+traj1 = pyspawn.traj(numdims, numstates)
+traj1.set_parameters(traj_params)
+
+sim = pyspawn.simulation()
+sim.add_traj(traj1)
+sim.set_parameters(sim_params)
+
+sim.propagate()
+
+# one more step on a new connection
+clients = pyspawn.tc_dispatcher.get_dispatcher().clients
+clients.disconnect(("localhost", 54321))
+traj1.compute_elec_struct(False)
+
+print "requests: ", requests
+print "connections: ", clients.get_nconnect()
+
+njobs = pyspawn.tc_dispatcher.get_dispatcher().get_njobs()[("localhost", 54321)]
+assert "energy_gradient_overlap" not in requests
+assert requests["energy"] == njobs
+assert requests["gradient"] == njobs
+assert requests["ci_vec_overlap"] == njobs - 1
+assert clients.get_nconnect()[("localhost", 54321)] == 2
+for f in os.listdir("."):
+    assert not f.startswith("CIvecs.Singlet.old") and not f.startswith("c0"), f